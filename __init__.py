@@ -1,2 +1,4 @@
+from . import controllers
 from . import models
 from . import tests
+from .hooks import pre_init_hook
@@ -1,6 +1,6 @@
 {
     'name': 'Retenção na Fonte Angola',
-    'version': '15.0.1.0.0',
+    'version': '15.0.1.1.0',
     'summary': 'Gestão de Retenção na Fonte (Angola)',
     'description': """
 Módulo para suportar Retenção na Fonte em Angola.
@@ -16,14 +16,24 @@ Módulo para suportar Retenção na Fonte em Angola.
         'security/security.xml',
         'security/ir.model.access.csv',
         'data/withholding_tax_data.xml',
+        'data/ir_config_parameter_data.xml',
+        'data/ir_cron_data.xml',
         'views/withholding_tax_views.xml',
         'views/account_move_views.xml',
+        'views/withholding_summary_views.xml',
+        'views/withholding_ledger_views.xml',
+        'views/withholding_queue_views.xml',
         'views/res_partner_views.xml',
+        'views/res_company_views.xml',
         'views/withholding_report_wizard_views.xml',
+        'views/withholding_assign_wizard_views.xml',
+        'views/withholding_perf_stat_views.xml',
         'report/reports.xml',
         'report/report_withholding.xml',
+        'report/report_withholding_certificate.xml',
         'report/report_payment_receipt.xml',
     ],
+    'pre_init_hook': 'pre_init_hook',
     'installable': True,
     'application': True,
 }
\ No newline at end of file
@@ -0,0 +1,18 @@
+from werkzeug.exceptions import NotFound
+
+from odoo import http
+from odoo.http import request
+
+
+class WithholdingExportController(http.Controller):
+
+    @http.route('/ao_withholding/export/<int:wizard_id>', type='http', auth='user')
+    def export_withholding(self, wizard_id, **kwargs):
+        wizard = request.env['withholding.report.wizard'].browse(wizard_id).exists()
+        if not wizard:
+            raise NotFound()
+        fp, filename, mimetype = wizard._export_to_file()
+        # O mesmo URL serve exportações diferentes e dados fiscais: nunca guardar em cache.
+        response = http.send_file(fp, mimetype=mimetype, as_attachment=True, filename=filename, cache_timeout=0)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
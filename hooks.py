@@ -0,0 +1,48 @@
+import logging
+
+from odoo.tools import sql
+
+_logger = logging.getLogger(__name__)
+
+# Colunas dos campos calculados armazenados que o ORM calcularia para todas
+# as faturas e linhas ao criá-las: (tabela, coluna, tipo SQL).
+WITHHOLDING_COLUMNS = [
+    ('account_move', 'withholding_amount', 'numeric'),
+    ('account_move', 'net_amount', 'numeric'),
+    ('account_move', 'withholding_dirty', 'boolean'),
+    ('account_move_line', 'withholding_rate', 'double precision'),
+]
+
+def create_withholding_columns(cr):
+    """
+    Cria as colunas dos campos calculados da retenção que ainda não existem,
+    já com valores iniciais, para que a instalação ou atualização do módulo
+    não recalcule numa só transação os campos de todas as faturas existentes.
+    Os valores reais das faturas com retenção são preenchidos depois, em
+    blocos, por `account.move._withholding_backfill`.
+    """
+    created = []
+    for table, column, column_type in WITHHOLDING_COLUMNS:
+        if not sql.column_exists(cr, table, column):
+            sql.create_column(cr, table, column, column_type)
+            created.append(column)
+    if 'withholding_amount' in created:
+        cr.execute("UPDATE account_move SET withholding_amount = 0")
+    if 'net_amount' in created:
+        cr.execute("UPDATE account_move SET net_amount = amount_total")
+    if 'withholding_dirty' in created:
+        cr.execute("UPDATE account_move SET withholding_dirty = FALSE")
+    if 'withholding_rate' in created and sql.column_exists(cr, 'account_move_line', 'withholding_tax_id'):
+        # Sem histórico de taxas, a taxa registada nas linhas existentes é a taxa atual.
+        cr.execute("""
+            UPDATE account_move_line line
+               SET withholding_rate = tax.percentage
+              FROM withholding_tax tax
+             WHERE tax.id = line.withholding_tax_id
+        """)
+    if created:
+        _logger.info("Retenção na Fonte: colunas criadas previamente: %s.", ", ".join(created))
+    return created
+
+def pre_init_hook(cr):
+    create_withholding_columns(cr)
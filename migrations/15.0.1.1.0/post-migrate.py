@@ -0,0 +1,18 @@
+from odoo import api, SUPERUSER_ID
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    # As retenções existentes passam a ter a taxa atual como taxa inicial do
+    # histórico, em vigor para todas as datas.
+    taxes = env['withholding.tax'].with_context(active_test=False).search([('rate_ids', '=', False)])
+    env['withholding.tax.rate'].create([{'tax_id': tax.id, 'percentage': tax.percentage} for tax in taxes])
+
+    # Os totais, o resumo e o razão das faturas existentes são preenchidos em
+    # blocos pela tarefa agendada, a partir da primeira fatura.
+    env['ir.config_parameter'].set_param('ao_withholding.backfill_last_id', 0)
+    env['ir.config_parameter'].set_param('ao_withholding.backfill_done', False)
+    cron = env.ref('ao_withholding.ir_cron_withholding_backfill', raise_if_not_found=False)
+    if cron:
+        cron.active = True
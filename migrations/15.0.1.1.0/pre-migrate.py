@@ -0,0 +1,6 @@
+from odoo.addons.ao_withholding.hooks import create_withholding_columns
+
+def migrate(cr, version):
+    if not version:
+        return
+    create_withholding_columns(cr)
@@ -1,4 +1,17 @@
+from . import withholding_perf_stat
 from . import withholding_tax
+from . import withholding_tax_rate
+from . import withholding_summary
+from . import withholding_ledger
+from . import withholding_queue
+from . import account_journal
 from . import account_move
+from . import res_company
 from . import res_partner
-from . import withholding_report_wizard
\ No newline at end of file
+from . import product_category
+from . import withholding_report_wizard
+from . import withholding_assign_wizard
+from . import withholding_report
+from . import withholding_certificate
+from . import report_payment_receipt
+from . import withholding_agt_declaration
\ No newline at end of file
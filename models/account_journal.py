@@ -0,0 +1,29 @@
+from odoo import models, api
+
+# Campos dos diários que determinam o diário de retenções por omissão: o
+# primeiro diário geral ativo da empresa, pela ordem dos diários (`sequence`).
+WITHHOLDING_JOURNAL_FIELDS = {'type', 'company_id', 'active', 'sequence'}
+
+class AccountJournal(models.Model):
+    _inherit = 'account.journal'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        journals = super().create(vals_list)
+        if any(journal.type == 'general' for journal in journals):
+            self.env['res.company'].clear_caches()
+        return journals
+
+    def write(self, vals):
+        fnames = WITHHOLDING_JOURNAL_FIELDS.intersection(vals)
+        # Só os diários gerais podem ser o diário de retenções.
+        journals = self if 'type' in fnames else self.filtered(lambda journal: journal.type == 'general')
+        with self.env['res.company']._invalidate_withholding_config(journals, fnames):
+            return super().write(vals)
+
+    def unlink(self):
+        general = any(journal.type == 'general' for journal in self)
+        res = super().unlink()
+        if general:
+            self.env['res.company'].clear_caches()
+        return res
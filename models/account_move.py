@@ -1,5 +1,64 @@
+import logging
+import random
+import time
+import zlib
+from collections import defaultdict
+
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError, ValidationError
+from odoo.tools import split_every
+
+from .withholding_perf_stat import withholding_profiled
+
+_logger = logging.getLogger(__name__)
+
+# A partir deste número de faturas o recálculo da retenção é feito por SQL,
+# agregado na base de dados, em vez de percorrer as linhas em Python.
+WITHHOLDING_SQL_THRESHOLD = 1000
+WITHHOLDING_SQL_CHUNK = 10000
+
+# Taxa de câmbio da fatura para a moeda da empresa, a mesma com que a fatura foi
+# contabilizada. Requer o alias `move`.
+WITHHOLDING_COMPANY_RATE_SQL = """
+    CASE WHEN move.amount_total <> 0
+         THEN ABS(move.amount_total_signed / move.amount_total)
+         ELSE 1
+    END
+"""
+
+# Número de tentativas de obter sem espera os bloqueios dos parceiros antes de
+# criar os lançamentos de retenção; esgotadas, espera-se pelos bloqueios.
+WITHHOLDING_LOCK_RETRIES = 5
+
+
+class WithholdingLockNotAvailable(Exception):
+    """ Um bloqueio consultivo de parceiro está na posse de outra transação. """
+
+
+def _withholding_lock_int(value):
+    """Converte `value` num inteiro de 32 bits com sinal, como `pg_advisory_xact_lock(int, int)` exige."""
+    key = zlib.crc32(value.encode())
+    return key - 2 ** 32 if key >= 2 ** 31 else key
+
+
+# Primeira chave dos bloqueios consultivos (empresa, parceiro): isola-os dos
+# bloqueios consultivos de dois inteiros obtidos por outros módulos.
+WITHHOLDING_LOCK_NAMESPACE = _withholding_lock_int('ao_withholding.partner')
+
+# Número de linhas tratadas por bloco na atribuição em massa das retenções padrão.
+WITHHOLDING_ASSIGN_CHUNK = 5000
+
+# Número de faturas tratadas por bloco (e por commit) no preenchimento dos dados existentes.
+WITHHOLDING_BACKFILL_CHUNK = 1000
+
+# Valor retido de uma linha em SQL, segundo a política de arredondamento da empresa.
+# Requer os aliases `line`, `company` e `cur` (moeda da fatura).
+WITHHOLDING_LINE_AMOUNT_SQL = """
+    CASE WHEN company.withholding_rounding = 'line'
+         THEN ROUND(line.price_subtotal * line.withholding_rate::numeric / 100 / cur.rounding::numeric) * cur.rounding::numeric
+         ELSE line.price_subtotal * line.withholding_rate::numeric / 100
+    END
+"""
 
 class AccountMove(models.Model):
     _inherit = 'account.move'
@@ -17,194 +76,818 @@ class AccountMove(models.Model):
         readonly=True
     )
 
-    withholding_by_group = fields.Binary(
+    withholding_dirty = fields.Boolean(
+        string="Totais por Recalcular",
+        compute='_compute_withholding_dirty',
+        store=True,
+        readonly=True,
+        copy=False,
+        help="Indica que as linhas, os subtotais ou as retenções da fatura mudaram "
+             "desde o último recálculo dos totais feito antes da certificação."
+    )
+    withholding_state = fields.Selection([
+        ('pending', 'Retenção Pendente'),
+        ('done', 'Retenção Lançada'),
+        ('failed', 'Retenção com Erro'),
+    ], string="Estado da Retenção", readonly=True, copy=False,
+        help="Estado dos lançamentos de retenção quando estes são criados em diferido.")
+    withholding_origin_id = fields.Many2one(
+        'account.move',
+        string="Fatura de Origem da Retenção",
+        index=True,
+        readonly=True,
+        copy=False,
+        help="Fatura que originou este lançamento de retenção."
+    )
+
+    withholding_summary_ids = fields.One2many(
+        'withholding.summary',
+        'move_id',
         string="Resumo de Retenções",
-        compute='_compute_withholding_by_group',
-        help='Utilizado para mostrar os totais de retenção agrupados no relatório.'
+        compute='_compute_withholding_summary',
+        store=True,
+        readonly=True,
+        help='Totais de retenção agrupados por taxa, utilizados no formulário e no relatório.'
     )
 
-    def _compute_withholding_by_group(self):
+    @api.depends('invoice_line_ids.price_subtotal', 'invoice_line_ids.withholding_tax_id', 'invoice_line_ids.withholding_rate')
+    def _compute_withholding_summary(self):
         for move in self:
-            withholding_groups = {}
-            for line in move.invoice_line_ids.filtered(lambda l: l.withholding_tax_id):
-                tax = line.withholding_tax_id
-                if tax not in withholding_groups:
-                    withholding_groups[tax] = {'base': 0.0, 'amount': 0.0}
-
-                withholding_groups[tax]['base'] += line.price_subtotal
-                withholding_groups[tax]['amount'] += line.price_subtotal * (tax.percentage / 100)
-
-            move.withholding_by_group = [
-                (
-                    tax.name,
-                    group['base'],
-                    group['amount']
-                )
-                for tax, group in withholding_groups.items()
-            ]
-
-    @api.depends('invoice_line_ids.price_subtotal', 'invoice_line_ids.withholding_tax_id')
+            commands = [(5, 0, 0)]
+            for tax, group in move._get_withholding_groups().items():
+                commands.append((0, 0, {
+                    'withholding_tax_id': tax.id,
+                    'rate': group['rate'],
+                    'base': group['base'],
+                    'amount': group['amount'],
+                }))
+            move.withholding_summary_ids = commands
+
+    @api.depends(
+        'invoice_line_ids.price_subtotal',
+        'invoice_line_ids.withholding_tax_id',
+        'invoice_line_ids.withholding_rate',
+        'line_ids.balance',
+        'line_ids.amount_currency',
+        'line_ids.tax_ids',
+    )
+    def _compute_withholding_dirty(self):
+        # Qualquer alteração às dependências marca a fatura; a marca é limpa em `certify`.
+        self.withholding_dirty = True
+
+    @api.depends('invoice_line_ids.price_subtotal', 'invoice_line_ids.withholding_tax_id', 'invoice_line_ids.withholding_rate')
+    @withholding_profiled('compute_withholding')
     def _compute_withholding(self):
-        for move in self:
-            withholding_amount = 0.0
-            for line in move.invoice_line_ids:
-                if line.withholding_tax_id:
-                    withholding_amount += line.price_subtotal * (line.withholding_tax_id.percentage / 100)
+        moves = self
+        if len(self) >= WITHHOLDING_SQL_THRESHOLD:
+            # Recálculo em massa (instalação, atualização, alteração de taxas):
+            # os totais são agregados na base de dados por fatura.
+            stored_moves = self.filtered('id')
+            withholding_amounts = stored_moves._get_withholding_amounts_sql()
+            for move in stored_moves:
+                move.withholding_amount = withholding_amounts.get(move.id, 0.0)
+                move.net_amount = move.amount_total - move.withholding_amount
+            moves = self - stored_moves
+
+        for move in moves:
+            withholding_amount = sum(group['amount'] for group in move._get_withholding_groups().values())
             move.withholding_amount = withholding_amount
             move.net_amount = move.amount_total - move.withholding_amount
 
+    def _get_withholding_amounts_sql(self):
+        """
+        Devolve um dicionário {move_id: valor da retenção} agregando
+        `price_subtotal * withholding_rate` das linhas da fatura diretamente na base de dados.
+        """
+        self.env['account.move.line'].flush(['move_id', 'price_subtotal', 'withholding_tax_id', 'withholding_rate', 'exclude_from_invoice_tab'])
+        self.env['res.company'].flush(['withholding_rounding'])
+        self.flush(['company_id', 'currency_id'])
+        withholding_amounts = {}
+        for ids in split_every(WITHHOLDING_SQL_CHUNK, self.ids):
+            self.env.cr.execute("""
+                SELECT line.move_id, SUM(%s)
+                  FROM account_move_line line
+                  JOIN account_move move ON move.id = line.move_id
+                  JOIN res_company company ON company.id = move.company_id
+                  JOIN res_currency cur ON cur.id = move.currency_id
+                 WHERE line.move_id IN %%s
+                   AND line.withholding_tax_id IS NOT NULL
+                   AND line.exclude_from_invoice_tab IS NOT TRUE
+              GROUP BY line.move_id
+            """ % WITHHOLDING_LINE_AMOUNT_SQL, [tuple(ids)])
+            withholding_amounts.update(self.env.cr.fetchall())
+        return withholding_amounts
+
+    def _recompute_withholding_sql(self, chunk_size=WITHHOLDING_SQL_CHUNK):
+        """
+        Recalcula `withholding_amount` e `net_amount` por SQL, em blocos de
+        `chunk_size` faturas, escrevendo diretamente os resultados na tabela.
+        Destina-se a grandes volumes (scripts de atualização, hooks), sem
+        passar pelo recálculo registo a registo do ORM.
+        """
+        self.env['account.move.line'].flush(['move_id', 'price_subtotal', 'withholding_tax_id', 'withholding_rate', 'exclude_from_invoice_tab'])
+        self.env['res.company'].flush(['withholding_rounding'])
+        self.flush(['amount_total', 'company_id', 'currency_id'])
+        fields_to_recompute = [self._fields['withholding_amount'], self._fields['net_amount']]
+        for ids in split_every(chunk_size, self.ids):
+            self.env.cr.execute("""
+                UPDATE account_move move
+                   SET withholding_amount = agg.amount,
+                       net_amount = move.amount_total - agg.amount
+                  FROM (
+                        SELECT m.id AS move_id,
+                               COALESCE(
+                                   ROUND(SUM(%s) / cur.rounding::numeric) * cur.rounding::numeric, 0
+                               ) AS amount
+                          FROM account_move m
+                          JOIN res_company company ON company.id = m.company_id
+                          JOIN res_currency cur ON cur.id = m.currency_id
+                     LEFT JOIN account_move_line line ON line.move_id = m.id
+                                                     AND line.withholding_tax_id IS NOT NULL
+                                                     AND line.exclude_from_invoice_tab IS NOT TRUE
+                         WHERE m.id IN %%s
+                      GROUP BY m.id, cur.rounding
+                       ) agg
+                 WHERE move.id = agg.move_id
+            """ % WITHHOLDING_LINE_AMOUNT_SQL, [tuple(ids)])
+            records = self.browse(ids)
+            for field in fields_to_recompute:
+                self.env.remove_to_compute(field, records)
+            records.invalidate_cache(['withholding_amount', 'net_amount'], ids)
+
+    @api.model
+    def _withholding_backfill(self, chunk_size=None, summary=True, ledger=True, auto_commit=True, reset=False):
+        """
+        Preenche os dados de retenção dos lançamentos existentes (totais e,
+        opcionalmente, o resumo e o razão das faturas lançadas), por ordem de
+        id e em blocos de `chunk_size`, com um commit por bloco. O último id
+        tratado fica em `ao_withholding.backfill_last_id`, pelo que uma
+        execução interrompida continua onde ficou. Concluído o preenchimento,
+        `ao_withholding.backfill_done` fica marcado e as execuções seguintes
+        da tarefa agendada terminam de imediato.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not reset and ICP.get_param('ao_withholding.backfill_done'):
+            return 0
+        if chunk_size is None:
+            chunk_size = int(ICP.get_param('ao_withholding.backfill_chunk_size', WITHHOLDING_BACKFILL_CHUNK))
+        last_id = 0 if reset else int(ICP.get_param('ao_withholding.backfill_last_id', 0))
+        self.env.cr.execute("SELECT COUNT(*) FROM account_move WHERE id > %s", [last_id])
+        total = self.env.cr.fetchone()[0]
+        done = 0
+        while True:
+            self.env.cr.execute("""
+                SELECT id FROM account_move WHERE id > %s ORDER BY id LIMIT %s
+            """, [last_id, chunk_size])
+            ids = [row[0] for row in self.env.cr.fetchall()]
+            if not ids:
+                break
+            moves = self.browse(ids)
+            moves._recompute_withholding_sql(chunk_size)
+
+            self.env.cr.execute("""
+                SELECT DISTINCT line.move_id
+                  FROM account_move_line line
+                 WHERE line.move_id IN %s
+                   AND line.withholding_tax_id IS NOT NULL
+            """, [tuple(ids)])
+            invoices = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if summary and invoices:
+                self.env.add_to_compute(self._fields['withholding_summary_ids'], invoices)
+                invoices.recompute(['withholding_summary_ids'])
+                invoices.flush()
+            if ledger and invoices:
+                invoices.filtered(lambda move: move.state == 'posted')._backfill_withholding_ledger()
+
+            last_id = ids[-1]
+            done += len(ids)
+            ICP.set_param('ao_withholding.backfill_last_id', last_id)
+            if auto_commit:
+                self.env.cr.commit()
+            self.invalidate_cache()
+            _logger.info("Retenção na Fonte: dados de %s/%s lançamentos preenchidos (último id %s).", done, total, last_id)
+
+        # Concluído: os lançamentos novos seguem o cálculo normal. O registo da
+        # tarefa agendada não é alterado aqui, porque o agendador o mantém
+        # bloqueado durante a execução.
+        ICP.set_param('ao_withholding.backfill_done', True)
+        _logger.info("Retenção na Fonte: preenchimento concluído.")
+        return done
+
+    def _backfill_withholding_ledger(self):
+        """
+        Cria o razão de retenções das faturas lançadas que ainda não o têm, a
+        partir dos lançamentos de retenção já existentes. Os lançamentos criados
+        antes de `withholding_origin_id` são associados à fatura pela referência.
+        """
+        if not self:
+            return
+        self.env.cr.execute("SELECT DISTINCT move_id FROM withholding_ledger WHERE move_id IN %s", [tuple(self.ids)])
+        with_ledger_ids = {row[0] for row in self.env.cr.fetchall()}
+        invoices = self.filtered(lambda move: move.id not in with_ledger_ids)
+        if not invoices:
+            return
+
+        withholding_moves = self.search([
+            ('withholding_origin_id', 'in', invoices.ids),
+            ('state', '=', 'posted'),
+        ])
+        moves_by_invoice = defaultdict(lambda: self.env['account.move'])
+        for withholding_move in withholding_moves:
+            moves_by_invoice[withholding_move.withholding_origin_id] |= withholding_move
+
+        # Lançamentos anteriores a `withholding_origin_id`: a referência contém
+        # ": <número da fatura> (", qualquer que seja a língua em que foram criados.
+        legacy_invoices = invoices.filtered(lambda move: move not in moves_by_invoice and move.name)
+        if legacy_invoices:
+            self.flush(['name', 'ref', 'state', 'move_type', 'company_id', 'partner_id', 'withholding_origin_id'])
+            self.env.cr.execute("""
+                SELECT invoice.id, withholding_move.id
+                  FROM account_move invoice
+                  JOIN account_move withholding_move
+                       ON withholding_move.company_id = invoice.company_id
+                      AND withholding_move.partner_id = invoice.partner_id
+                      AND withholding_move.move_type = 'entry'
+                      AND withholding_move.state = 'posted'
+                      AND withholding_move.withholding_origin_id IS NULL
+                      AND strpos(withholding_move.ref, ': ' || invoice.name || ' (') > 0
+                 WHERE invoice.id IN %s
+            """, [tuple(legacy_invoices.ids)])
+            legacy_move_ids = defaultdict(list)
+            for invoice_id, move_id in self.env.cr.fetchall():
+                legacy_move_ids[invoice_id].append(move_id)
+            for invoice_id, move_ids in legacy_move_ids.items():
+                legacy_moves = self.browse(move_ids)
+                legacy_moves.write({'withholding_origin_id': invoice_id})
+                moves_by_invoice[self.browse(invoice_id)] = legacy_moves
+
+        ledger_vals_list = []
+        for invoice, moves in moves_by_invoice.items():
+            for withholding_move, tax_ids in invoice._map_withholding_move_taxes(moves).items():
+                ledger_vals_list += invoice._prepare_withholding_ledger_vals(withholding_move, tax_ids)
+        self.env['withholding.ledger'].sudo().create(ledger_vals_list)
+
+    def _map_withholding_move_taxes(self, withholding_moves):
+        """
+        Devolve {lançamento de retenção: [ids das retenções]} associando cada
+        retenção do resumo da fatura a uma única linha de provisão: a linha na
+        conta da retenção com o valor mais próximo do valor retido. Duas
+        retenções na mesma conta ficam assim em linhas distintas. O valor da
+        linha é lido na moeda da fatura; os lançamentos antigos, sem moeda da
+        fatura, registaram-no diretamente a crédito.
+        """
+        self.ensure_one()
+        remaining = {summary.withholding_tax_id: summary.amount for summary in self.withholding_summary_ids}
+        tax_ids_by_move = {}
+        for withholding_move in withholding_moves.sorted('id'):
+            tax_ids = []
+            for line in withholding_move.line_ids.filtered(lambda line: line.credit).sorted('id'):
+                candidates = [tax for tax in remaining if tax.account_id == line.account_id]
+                if not candidates:
+                    continue
+                line_amount = -line.amount_currency if line.currency_id == self.currency_id else line.credit
+                tax = min(candidates, key=lambda tax: (abs(remaining[tax] - line_amount), tax.id))
+                del remaining[tax]
+                tax_ids.append(tax.id)
+            tax_ids_by_move[withholding_move] = tax_ids
+        return tax_ids_by_move
+
+    @withholding_profiled('post')
     def _post(self, soft=True):
         res = super()._post(soft)
-        for move in self:
-            if move.is_invoice(include_receipts=True) and move.withholding_amount > 0:
-                self._create_withholding_entry(move)
+        invoices = self.filtered(lambda m: m.is_invoice(include_receipts=True) and m.withholding_amount > 0)
+        deferred_invoices = invoices.filtered(lambda m: m.company_id._get_withholding_config().deferred)
+        if deferred_invoices:
+            self.env['withholding.queue'].sudo()._enqueue(deferred_invoices)
+        if invoices - deferred_invoices:
+            (invoices - deferred_invoices)._create_withholding_entries()
         return res
 
+    def button_draft(self):
+        res = super().button_draft()
+        self._cancel_withholding_moves()
+        self._reverse_withholding_ledger()
+        self.env['withholding.queue'].sudo()._dequeue(self)
+        return res
+
+    def button_cancel(self):
+        res = super().button_cancel()
+        self._cancel_withholding_moves()
+        self._reverse_withholding_ledger()
+        return res
+
+    def _cancel_withholding_moves(self):
+        """
+        Cancela os lançamentos de retenção lançados das faturas que voltaram a
+        rascunho ou foram canceladas, para que um novo lançamento da fatura não
+        duplique a retenção na contabilidade.
+        """
+        withholding_moves = self.search([
+            ('withholding_origin_id', 'in', self.ids),
+            ('state', '=', 'posted'),
+        ])
+        if withholding_moves:
+            # `button_draft` desfaz também a reconciliação com a fatura.
+            withholding_moves.button_draft()
+            withholding_moves.button_cancel()
+
+    def _reverse_withholding_ledger(self):
+        """
+        Anula no razão de retenções as retenções das faturas ou dos
+        lançamentos de retenção que voltaram a rascunho ou foram cancelados.
+        """
+        entries = self.env['withholding.ledger'].sudo().search([
+            '|', ('move_id', 'in', self.ids), ('withholding_move_id', 'in', self.ids),
+        ])
+        if entries:
+            entries._reverse_entries()
+
+    @withholding_profiled('certify')
     def certify(self):
         """
         Sobrescreve o método `certify` do módulo `opc_certification_ao`.
         O objetivo é forçar o recálculo dos totais imediatamente antes da
-        geração do hash para garantir que os dados estão corretos.
+        geração do hash para garantir que os dados estão corretos. Apenas as
+        faturas alteradas desde o último recálculo (ou com recálculo pendente
+        no ORM) são recalculadas.
         """
-        self._compute_amount()
-        self._compute_withholding()
+        dirty_moves = self._get_withholding_dirty_moves()
+        if dirty_moves:
+            dirty_moves._compute_amount()
+            dirty_moves._compute_withholding()
+            dirty_moves.write({'withholding_dirty': False})
         return super().certify()
 
-    def _create_withholding_entry(self, invoice):
-        withholding_map = {}
-        for line in invoice.invoice_line_ids:
+    def _get_withholding_dirty_moves(self):
+        """
+        Devolve as faturas cujos totais podem estar desatualizados: marcadas
+        como alteradas ou com algum dos totais ainda por recalcular no ORM.
+        """
+        total_fields = [self._fields[name] for name in ('amount_total', 'withholding_amount', 'net_amount')]
+        return self.filtered(lambda move: (
+            move.withholding_dirty
+            or any(self.env.is_to_compute(field, move) for field in total_fields)
+        ))
+
+    def _get_withholding_groups(self):
+        """
+        Devolve um dicionário {withholding.tax: {'rate': ..., 'base': ..., 'amount': ...}}
+        calculado a partir das linhas da fatura, com a taxa registada em cada
+        linha e segundo a política de arredondamento da empresa.
+        """
+        self.ensure_one()
+        round_per_line = self.company_id._get_withholding_config().rounding == 'line'
+        withholding_groups = {}
+        for line in self.invoice_line_ids:
             if line.withholding_tax_id:
                 tax = line.withholding_tax_id
-                amount = line.price_subtotal * (tax.percentage / 100)
-                if tax in withholding_map:
-                    withholding_map[tax] += amount
-                else:
-                    withholding_map[tax] = amount
-
-        # Encontrar a linha de contas a receber/pagar de forma robusta,
-        # verificando as contas configuradas no parceiro.
-        partner = invoice.partner_id
-        receivable_account = partner.property_account_receivable_id
-        payable_account = partner.property_account_payable_id
-
-        arp_line = self.env['account.move.line']
-        for line in invoice.line_ids:
-            if line.account_id in (receivable_account, payable_account):
-                arp_line = line
-                break
+                amount = line.price_subtotal * (line.withholding_rate / 100)
+                if round_per_line:
+                    amount = self.currency_id.round(amount)
+                group = withholding_groups.setdefault(tax, {'rate': line.withholding_rate, 'base': 0.0, 'amount': 0.0})
+                group['base'] += line.price_subtotal
+                group['amount'] += amount
+        return withholding_groups
 
-        if not arp_line:
-            return
+    def _get_withholding_map(self):
+        """
+        Devolve um dicionário {id da retenção: valor} com o total a reter
+        por taxa de retenção, lido do resumo de retenções já agregado.
+        """
+        self.ensure_one()
+        withholding_map = {}
+        for summary in self.withholding_summary_ids:
+            tax_id = summary.withholding_tax_id.id
+            withholding_map[tax_id] = withholding_map.get(tax_id, 0.0) + summary.amount
+        return withholding_map
+
+    def _get_withholding_counterpart_line(self):
+        """
+        Encontra a linha de contas a receber/pagar da fatura.
+        """
+        self.ensure_one()
+        for line in self.line_ids:
+            if line.account_internal_type in ('receivable', 'payable'):
+                return line
+        return self.env['account.move.line']
+
+    def _get_withholding_configs(self):
+        """
+        Devolve um dicionário {res.company: WithholdingConfig} com a
+        configuração em cache de cada empresa das faturas.
+        """
+        configs = {}
+        for company in self.company_id:
+            config = company._get_withholding_config()
+            # O lançamento da retenção deve ser criado num diário de "Operações Diversas"
+            # para não ser confundido com uma fatura por outros módulos (ex: certificação).
+            if not config.journal_id:
+                raise UserError(_("Não foi encontrado um diário do tipo 'Operações Diversas'. Por favor, crie um para continuar."))
+            configs[company] = config
+        return configs
+
+    def _get_withholding_tax_configs(self, config, withholding_map):
+        """
+        Devolve a configuração (`WithholdingTaxConfig`) de cada retenção de
+        `withholding_map`, validando que tem conta contabilística definida.
+        """
+        self.ensure_one()
+        tax_configs = []
+        for tax_id in withholding_map:
+            tax_config = config.taxes.get(tax_id)
+            if not tax_config:
+                tax = self.env['withholding.tax'].browse(tax_id)
+                raise UserError(_("A retenção '%s' não pertence à empresa %s.") % (tax.name, self.company_id.name))
+            if not tax_config.account_id:
+                raise UserError(_("A conta contabilística para a retenção '%s' não está definida.") % tax_config.name)
+            tax_configs.append(tax_config)
+        return tax_configs
 
-        # O lançamento da retenção deve ser criado num diário de "Operações Diversas"
-        # para não ser confundido com uma fatura por outros módulos (ex: certificação).
-        misc_journal = self.env['account.journal'].search([
-            ('type', '=', 'general'),
-            ('company_id', '=', invoice.company_id.id)
-        ], limit=1)
-        if not misc_journal:
-            raise UserError(_("Não foi encontrado um diário do tipo 'Operações Diversas'. Por favor, crie um para continuar."))
-
-        for tax, amount in withholding_map.items():
-            withholding_account = tax.account_id
-            if not withholding_account:
-                raise UserError(_("A conta contabilística para a retenção '%s' não está definida.") % tax.name)
-
-            move_vals = {
+    def _prepare_withholding_move_vals(self, arp_line, config, withholding_map):
+        """
+        Prepara os valores dos lançamentos de retenção de uma fatura: um
+        lançamento por cada taxa de retenção ou, se a empresa consolidar as
+        retenções, um único lançamento com uma linha por taxa.
+        """
+        self.ensure_one()
+        tax_configs = self._get_withholding_tax_configs(config, withholding_map)
+
+        if config.consolidate:
+            return [self._prepare_withholding_consolidated_move_vals(arp_line, config, withholding_map)]
+
+        rates = {summary.withholding_tax_id.id: summary.rate for summary in self.withholding_summary_ids}
+
+        vals_list = []
+        for tax in tax_configs:
+            amount = withholding_map[tax.id]
+            vals_list.append({
                 'move_type': 'entry',
-                'partner_id': invoice.partner_id.id,
-                'journal_id': misc_journal.id,
-                'date': invoice.date,
-                'ref': _('Retenção na Fatura: %s (%s)') % (invoice.name, tax.name),
+                'withholding_origin_id': self.id,
+                'partner_id': self.partner_id.id,
+                'journal_id': config.journal_id,
+                'date': self.date,
+                'ref': _('Retenção na Fatura: %s (%s)') % (self.name, tax.name),
                 'line_ids': [
-                    (0, 0, {
-                        'name': _('Valor da Retenção (%s%%)') % tax.percentage,
-                        'debit': amount,
-                        'credit': 0.0,
-                        'account_id': arp_line.account_id.id,
-                        'partner_id': invoice.partner_id.id,
-                    }),
-                    (0, 0, {
-                        'name': _('Provisão para %s') % tax.name,
-                        'debit': 0.0,
-                        'credit': amount,
-                        'account_id': withholding_account.id,
-                        'partner_id': invoice.partner_id.id,
-                    }),
+                    (0, 0, dict(
+                        self._prepare_withholding_line_amounts(amount),
+                        name=_('Valor da Retenção (%s%%)') % rates.get(tax.id, tax.percentage),
+                        account_id=arp_line.account_id.id,
+                        partner_id=self.partner_id.id,
+                    )),
+                    (0, 0, self._prepare_withholding_provision_line_vals(tax, amount)),
                 ]
-            }
-            withholding_move = self.env['account.move'].create(move_vals)
-            withholding_move._post()
+            })
+        return vals_list
+
+    def _prepare_withholding_consolidated_move_vals(self, arp_line, config, withholding_map):
+        """
+        Prepara um único lançamento com todas as retenções da fatura: uma linha
+        de contrapartida na conta a receber/pagar e uma linha por taxa de retenção.
+        """
+        self.ensure_one()
+        provision_vals_list = [
+            self._prepare_withholding_provision_line_vals(tax, withholding_map[tax.id])
+            for tax in self._get_withholding_tax_configs(config, withholding_map)
+        ]
+        # A contrapartida é a soma das provisões já convertidas, para que o
+        # lançamento fique equilibrado na moeda da empresa.
+        line_ids = [
+            (0, 0, {
+                'name': _('Valor da Retenção'),
+                'debit': sum(vals['credit'] for vals in provision_vals_list),
+                'credit': 0.0,
+                'amount_currency': self.currency_id.round(sum(withholding_map.values())),
+                'currency_id': self.currency_id.id,
+                'account_id': arp_line.account_id.id,
+                'partner_id': self.partner_id.id,
+            }),
+        ]
+        line_ids += [(0, 0, vals) for vals in provision_vals_list]
+        return {
+            'move_type': 'entry',
+            'withholding_origin_id': self.id,
+            'partner_id': self.partner_id.id,
+            'journal_id': config.journal_id,
+            'date': self.date,
+            'ref': _('Retenção na Fatura: %s') % self.name,
+            'line_ids': line_ids,
+        }
+
+    def _split_withholding_taxes(self, config, withholding_map):
+        """
+        Devolve, pela mesma ordem de `_prepare_withholding_move_vals`, a lista
+        dos ids das retenções incluídas em cada lançamento de retenção.
+        """
+        self.ensure_one()
+        if config.consolidate:
+            return [list(withholding_map)]
+        return [[tax_id] for tax_id in withholding_map]
+
+    def _prepare_withholding_ledger_vals(self, withholding_move, tax_ids):
+        """
+        Prepara os movimentos do razão de retenções de um lançamento de retenção
+        a partir do resumo de retenções da fatura.
+        """
+        self.ensure_one()
+        partner = self.partner_id
+        company_currency = self.company_id.currency_id
+        rate = self._get_withholding_company_rate()
+        return [{
+            'move_id': self.id,
+            'withholding_move_id': withholding_move.id,
+            'company_id': self.company_id.id,
+            'date': withholding_move.date,
+            'partner_id': partner.id,
+            'partner_vat': partner.vat,
+            'tax_id': summary.withholding_tax_id.id,
+            'tax_type': summary.tax_type,
+            'currency_id': self.currency_id.id,
+            'base': summary.base,
+            'amount': summary.amount,
+            'base_company': company_currency.round(summary.base * rate),
+            'amount_company': company_currency.round(summary.amount * rate),
+        } for summary in self.withholding_summary_ids if summary.withholding_tax_id.id in tax_ids]
+
+    def _get_withholding_company_rate(self):
+        """
+        Devolve a taxa de câmbio da moeda da fatura para a moeda da empresa
+        com que a fatura foi contabilizada (ver `WITHHOLDING_COMPANY_RATE_SQL`).
+        """
+        self.ensure_one()
+        if self.currency_id == self.company_id.currency_id or not self.amount_total:
+            return 1.0
+        return abs(self.amount_total_signed / self.amount_total)
+
+    def _prepare_withholding_line_amounts(self, amount):
+        """
+        Devolve os valores contabilísticos de uma linha de retenção de `amount`
+        na moeda da fatura (a débito se positivo, a crédito se negativo): o
+        valor na moeda da fatura e o saldo na moeda da empresa, convertido
+        como no razão de retenções.
+        """
+        self.ensure_one()
+        balance = self.company_id.currency_id.round(amount * self._get_withholding_company_rate())
+        return {
+            'debit': balance if balance > 0 else 0.0,
+            'credit': -balance if balance < 0 else 0.0,
+            'amount_currency': amount,
+            'currency_id': self.currency_id.id,
+        }
+
+    def _prepare_withholding_provision_line_vals(self, tax, amount):
+        self.ensure_one()
+        return dict(
+            self._prepare_withholding_line_amounts(-amount),
+            name=_('Provisão para %s') % tax.name,
+            account_id=tax.account_id,
+            partner_id=self.partner_id.id,
+        )
+
+    @withholding_profiled('create_withholding_entries')
+    def _create_withholding_entries(self):
+        """
+        Cria os lançamentos de retenção de todas as faturas do recordset de
+        uma só vez: um único `create` multi-registo, um único `_post` e uma
+        reconciliação por fatura, em vez de repetir estes passos por cada
+        fatura e por cada taxa de retenção.
+
+        Os bloqueios são obtidos por ordem determinística e sem espera: se um
+        deles estiver na posse de outra transação, os já obtidos são libertados
+        e a tentativa é repetida mais tarde. Esgotadas as tentativas, espera-se
+        pelos bloqueios.
+        """
+        if not self:
+            return self.env['account.move']
+
+        # Processar as faturas e obter os bloqueios sempre pela mesma ordem
+        # (empresa, parceiro), para que workers concorrentes não se bloqueiem
+        # mutuamente ao reconciliar as mesmas contas do mesmo parceiro.
+        invoices = self.sorted(lambda move: (move.company_id.id, move.commercial_partner_id.id, move.id))
+
+        for attempt in range(1, WITHHOLDING_LOCK_RETRIES + 1):
+            try:
+                # Os bloqueios obtidos dentro do savepoint são libertados se
+                # este for desfeito, para não os manter durante a espera.
+                with self.env.cr.savepoint():
+                    invoices._lock_withholding_partners(wait=False)
+            except WithholdingLockNotAvailable:
+                delay = random.uniform(0, 0.05 * 2 ** attempt)
+                _logger.info("Bloqueio indisponível ao criar lançamentos de retenção, nova tentativa (%s) em %.2fs.",
+                             attempt, delay)
+                time.sleep(delay)
+            else:
+                return invoices._create_withholding_entries_locked()
+
+        invoices._lock_withholding_partners()
+        return invoices._create_withholding_entries_locked()
+
+    def _get_withholding_lock_keys(self):
+        """
+        Devolve, por ordem crescente, as chaves dos bloqueios consultivos a
+        obter: a segunda chave de `WITHHOLDING_LOCK_NAMESPACE`, calculada a
+        partir da empresa e do parceiro.
+        """
+        return sorted({
+            _withholding_lock_int('%s,%s' % (move.company_id.id, move.commercial_partner_id.id))
+            for move in self
+        })
+
+    def _lock_withholding_partners(self, wait=True):
+        """
+        Obtém, por ordem determinística, um bloqueio consultivo por empresa e
+        parceiro, libertado no fim da transação. Sem `wait`, levanta
+        `WithholdingLockNotAvailable` se um dos bloqueios não estiver livre.
+        """
+        for key in self._get_withholding_lock_keys():
+            if wait:
+                self.env.cr.execute("SELECT pg_advisory_xact_lock(%s, %s)", [WITHHOLDING_LOCK_NAMESPACE, key])
+                continue
+            self.env.cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", [WITHHOLDING_LOCK_NAMESPACE, key])
+            if not self.env.cr.fetchone()[0]:
+                raise WithholdingLockNotAvailable()
+
+    def _create_withholding_entries_locked(self):
+        """
+        Cria, lança e reconcilia os lançamentos de retenção das faturas, já
+        ordenadas e com os bloqueios consultivos obtidos.
+        """
+        configs = self._get_withholding_configs()
+
+        vals_list = []
+        arp_lines = []
+        move_taxes = []
+        for invoice in self:
+            withholding_map = invoice._get_withholding_map()
+            if not withholding_map:
+                continue
+            arp_line = invoice._get_withholding_counterpart_line()
+            if not arp_line:
+                continue
+            config = configs[invoice.company_id]
+            move_vals_list = invoice._prepare_withholding_move_vals(arp_line, config, withholding_map)
+            vals_list += move_vals_list
+            arp_lines += [arp_line] * len(move_vals_list)
+            move_taxes += invoice._split_withholding_taxes(config, withholding_map)
+
+        if not vals_list:
+            return self.env['account.move']
+
+        withholding_moves = self.env['account.move'].create(vals_list)
+        withholding_moves._post()
+
+        # Agrupar as linhas a reconciliar por linha de contas a receber/pagar da
+        # fatura: cada fatura é reconciliada uma única vez com todas as suas retenções,
+        # por ordem de conta e parceiro.
+        to_reconcile = {}
+        for arp_line, withholding_move in zip(arp_lines, withholding_moves):
+            counterpart = withholding_move.line_ids.filtered(lambda l: l.account_id == arp_line.account_id)
+            to_reconcile[arp_line] = to_reconcile.get(arp_line, arp_line) | counterpart
+        for arp_line in sorted(to_reconcile, key=lambda line: (line.account_id.id, line.partner_id.id, line.id)):
+            to_reconcile[arp_line].reconcile()
 
-            (arp_line | withholding_move.line_ids.filtered(lambda l: l.account_id == arp_line.account_id)).reconcile()
+        ledger_vals_list = []
+        for withholding_move, tax_ids in zip(withholding_moves, move_taxes):
+            ledger_vals_list += withholding_move.withholding_origin_id._prepare_withholding_ledger_vals(withholding_move, tax_ids)
+        self.env['withholding.ledger'].sudo().create(ledger_vals_list)
+
+        return withholding_moves
+
+    def _create_withholding_entry(self, invoice):
+        """
+        Mantido por compatibilidade: cria os lançamentos de retenção de uma única fatura.
+        """
+        return invoice._create_withholding_entries()
 
     @api.model
-    def create(self, vals):
+    def _get_new_line_withholding(self, line_commands):
+        """
+        Devolve, pela ordem dos comandos, os `vals` de cada comando de criação
+        (0, _, vals) das linhas da fatura.
+        """
+        return [
+            command[2]
+            for command in line_commands or []
+            if command and command[0] == 0
+        ]
+
+    def _restore_line_withholding(self, withholding_by_line_id):
+        """
+        Repõe `withholding_tax_id` nas linhas indicadas em {line_id: wht_id},
+        com uma única escrita por taxa de retenção e apenas nas linhas cujo
+        valor se perdeu.
+        """
+        lines = self.env['account.move.line'].browse(list(withholding_by_line_id))
+        line_ids_by_tax = defaultdict(list)
+        for line in lines:
+            wht_id = withholding_by_line_id[line.id] or False
+            if line.withholding_tax_id.id != wht_id:
+                line_ids_by_tax[wht_id].append(line.id)
+        for wht_id, line_ids in line_ids_by_tax.items():
+            self.env['account.move.line'].browse(line_ids).write({'withholding_tax_id': wht_id})
+
+    @api.model
+    def _withholding_line_matches(self, line, vals):
+        """
+        Indica se a linha criada é compatível com os `vals` do comando de criação.
+        """
+        return (
+            ('display_type' not in vals or line.display_type == (vals['display_type'] or False))
+            and ('product_id' not in vals or line.product_id.id == (vals['product_id'] or False))
+            and ('name' not in vals or (line.name or False) == (vals['name'] or False))
+        )
+
+    def _map_new_line_withholding(self, new_line_vals, existing_line_ids=()):
+        """
+        Associa cada comando de criação à linha da fatura que originou: as
+        linhas criadas por `invoice_line_ids` têm ids crescentes pela ordem
+        dos comandos. A linha na posição do comando é confirmada contra os
+        seus `vals` e, se não for compatível, procura-se a primeira linha nova
+        ainda livre que o seja. Devolve {line_id: wht_id} apenas para os
+        comandos com retenção.
+        """
+        withholding_by_line_id = {}
+        for move in self:
+            new_lines = move.invoice_line_ids.filtered(lambda line: line.id not in existing_line_ids).sorted('id')
+            if len(new_lines) != len(new_line_vals):
+                _logger.warning("Fatura %s: %s linhas novas para %s comandos de criação, associação das retenções por conteúdo.",
+                                move.id, len(new_lines), len(new_line_vals))
+            free_lines = list(new_lines)
+            for index, vals in enumerate(new_line_vals):
+                line = new_lines[index] if index < len(new_lines) else None
+                if line not in free_lines or not self._withholding_line_matches(line, vals):
+                    line = next((l for l in free_lines if self._withholding_line_matches(l, vals)), None)
+                if line is None:
+                    if vals.get('withholding_tax_id'):
+                        _logger.warning("Fatura %s: linha do comando de criação %s não encontrada, retenção %s não reposta.",
+                                        move.id, index, vals['withholding_tax_id'])
+                    continue
+                free_lines.remove(line)
+                if vals.get('withholding_tax_id'):
+                    withholding_by_line_id[line.id] = vals['withholding_tax_id']
+        return withholding_by_line_id
+
+    @api.model_create_multi
+    def create(self, vals_list):
         """
         Sobrescreve o método create para garantir que o campo `withholding_tax_id` não é perdido.
         """
         # Extrair os valores de retenção das linhas de produto nos `vals` de entrada.
-        withholding_values = []
-        if 'invoice_line_ids' in vals:
-            for line_command in vals.get('invoice_line_ids', []):
-                if line_command and line_command[0] == 0:
-                    line_vals = line_command[2]
-                    withholding_values.append(line_vals.get('withholding_tax_id'))
+        new_line_vals_list = [
+            self._get_new_line_withholding(vals.get('invoice_line_ids'))
+            for vals in vals_list
+        ]
 
         # Chamar o `create` original. O Odoo pode limpar o campo `withholding_tax_id` aqui.
-        move = super(AccountMove, self).create(vals)
+        moves = super(AccountMove, self).create(vals_list)
 
-        # Restaurar os valores de retenção, fazendo a correspondência de forma robusta.
-        # Filtramos as linhas para ignorar as que são de impostos, pois estas não
-        # correspondem diretamente às linhas de entrada.
-        product_lines = move.invoice_line_ids.filtered(lambda line: not line.tax_line_id)
+        # Restaurar os valores de retenção, associando cada comando de criação à linha criada.
+        withholding_by_line_id = {}
+        for move, new_line_vals in zip(moves, new_line_vals_list):
+            if any(vals.get('withholding_tax_id') for vals in new_line_vals):
+                withholding_by_line_id.update(move._map_new_line_withholding(new_line_vals))
+        if withholding_by_line_id:
+            moves._restore_line_withholding(withholding_by_line_id)
 
-        if withholding_values and len(product_lines) == len(withholding_values):
-            for i, line in enumerate(product_lines):
-                wht_id = withholding_values[i]
-                if wht_id and not line.withholding_tax_id:
-                    line.withholding_tax_id = wht_id
-
-        return move
+        return moves
 
     def write(self, vals):
         """
         Sobrescreve o método write para garantir que o campo `withholding_tax_id` não é perdido.
         """
-        if 'invoice_line_ids' in vals:
-            # Guardar os IDs das linhas existentes para identificar as novas mais tarde.
-            existing_line_ids = self.invoice_line_ids.ids
-
-            # Extrair valores de retenção antes que se percam.
-            line_updates = {}
-            new_line_withholding = []
-            for command in vals['invoice_line_ids']:
-                if command[0] == 1:  # Update
-                    if 'withholding_tax_id' in command[2]:
-                        line_updates[command[1]] = command[2]['withholding_tax_id']
-                elif command[0] == 0:  # Create
-                    new_line_withholding.append(command[2].get('withholding_tax_id'))
-
-            res = super(AccountMove, self).write(vals)
-
-            # Restaurar valores.
-            if line_updates:
-                for line_id, wht_id in line_updates.items():
-                    self.env['account.move.line'].browse(line_id).write({'withholding_tax_id': wht_id})
-            
-            if new_line_withholding:
-                self.ensure_one() # Assumimos que estamos a editar uma fatura de cada vez.
-                new_lines = self.invoice_line_ids.filtered(lambda l: l.id not in existing_line_ids)
-                product_lines = new_lines.filtered(lambda l: not l.tax_line_id and not l.display_type)
-
-                if len(product_lines) == len(new_line_withholding):
-                    for i, line in enumerate(product_lines):
-                        wht_id = new_line_withholding[i]
-                        if wht_id and not line.withholding_tax_id:
-                            line.withholding_tax_id = wht_id
-            return res
-        
-        return super(AccountMove, self).write(vals)
+        if 'invoice_line_ids' not in vals:
+            return super(AccountMove, self).write(vals)
+
+        # Extrair valores de retenção antes que se percam.
+        withholding_by_line_id = {}
+        for command in vals['invoice_line_ids']:
+            if command and command[0] == 1 and 'withholding_tax_id' in command[2]:  # Update
+                withholding_by_line_id[command[1]] = command[2]['withholding_tax_id']
+        new_line_vals = self._get_new_line_withholding(vals['invoice_line_ids'])
+        has_new_withholding = any(line_vals.get('withholding_tax_id') for line_vals in new_line_vals)
+
+        # Guardar os IDs das linhas existentes para identificar as novas mais tarde.
+        existing_line_ids = set(self.invoice_line_ids.ids) if has_new_withholding else set()
+
+        res = super(AccountMove, self).write(vals)
+
+        # Restaurar valores. Os comandos de criação aplicam-se a cada uma das faturas.
+        if has_new_withholding:
+            withholding_by_line_id.update(self._map_new_line_withholding(new_line_vals, existing_line_ids))
+        if withholding_by_line_id:
+            self._restore_line_withholding(withholding_by_line_id)
+        return res
+
+    @api.model
+    def load(self, fields, data):
+        """
+        Na importação de faturas de fornecedor, aplica as retenções padrão dos
+        parceiros às linhas importadas sem retenção.
+        """
+        res = super(AccountMove, self).load(fields, data)
+        if res.get('ids') and not self.env.context.get('withholding_skip_defaults'):
+            lines = self.browse(res['ids']).invoice_line_ids.filtered(lambda line: not line.withholding_tax_id)
+            lines._apply_withholding_defaults()
+        return res
 
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
@@ -214,4 +897,85 @@ class AccountMoveLine(models.Model):
         string="Retenção na Fonte",
         domain="[('company_id', '=', company_id)]",
         help="Selecione o tipo de retenção a aplicar nesta linha da fatura."
-    )
\ No newline at end of file
+    )
+    withholding_rate = fields.Float(
+        string="% Retenção",
+        compute='_compute_withholding_rate',
+        store=True,
+        readonly=True,
+        copy=False,
+        help="Taxa da retenção em vigor na data da fatura, registada na linha. "
+             "As alterações posteriores ao histórico de taxas não a afetam."
+    )
+
+    @api.depends('withholding_tax_id', 'move_id.invoice_date', 'move_id.date')
+    def _compute_withholding_rate(self):
+        configs = {}
+        for line in self:
+            if not line.withholding_tax_id:
+                line.withholding_rate = 0.0
+                continue
+            company = line.company_id or line.move_id.company_id or self.env.company
+            if company not in configs:
+                configs[company] = company._get_withholding_config()
+            tax_config = configs[company].taxes.get(line.withholding_tax_id.id)
+            rate_date = line.move_id.invoice_date or line.move_id.date or fields.Date.context_today(line)
+            line.withholding_rate = tax_config.get_rate(rate_date) if tax_config else line.withholding_tax_id.percentage
+
+    def _get_withholding_default_map(self, use_category=False):
+        """
+        Devolve {line_id: wht_id} com a retenção padrão de cada linha: a da
+        categoria do produto (se `use_category`) ou a do parceiro da fatura,
+        ou, na sua falta, a do parceiro comercial. Os parceiros são lidos de
+        uma só vez e só são aceites retenções da empresa da linha.
+        """
+        partners = self.move_id.partner_id
+        partners |= partners.commercial_partner_id
+        partner_tax = {
+            values['id']: values['withholding_tax_id'] and values['withholding_tax_id'][0]
+            for values in partners.read(['withholding_tax_id'])
+        }
+        configs = {company: company._get_withholding_config() for company in self.company_id}
+
+        default_map = {}
+        for line in self:
+            config = configs[line.company_id]
+            wht_id = False
+            if use_category and line.product_id.categ_id.withholding_tax_type:
+                wht_id = config.default_tax_ids.get(line.product_id.categ_id.withholding_tax_type)
+            if not wht_id:
+                partner = line.move_id.partner_id
+                wht_id = partner_tax.get(partner.id) or partner_tax.get(partner.commercial_partner_id.id)
+            if wht_id in config.taxes:
+                default_map[line.id] = wht_id
+        return default_map
+
+    def _apply_withholding_defaults(self, use_category=False, overwrite=False):
+        """
+        Atribui em massa a retenção padrão às linhas de faturas de fornecedor em
+        rascunho. Em cada bloco as linhas são escritas com uma única escrita por
+        retenção e os totais das faturas são recalculados uma só vez, no fim do bloco.
+        Devolve o número de linhas alteradas.
+        """
+        lines = self.filtered(lambda line: (
+            line.move_id.state == 'draft'
+            and line.move_id.move_type in ('in_invoice', 'in_refund')
+            and not line.exclude_from_invoice_tab
+            and not line.display_type
+            and (overwrite or not line.withholding_tax_id)
+        ))
+        updated = 0
+        for line_ids in split_every(WITHHOLDING_ASSIGN_CHUNK, lines.ids):
+            chunk = self.browse(line_ids)
+            line_ids_by_tax = defaultdict(list)
+            for line_id, wht_id in chunk._get_withholding_default_map(use_category).items():
+                line_ids_by_tax[wht_id].append(line_id)
+            for wht_id, tax_line_ids in line_ids_by_tax.items():
+                tax_lines = self.browse(tax_line_ids).filtered(lambda line: line.withholding_tax_id.id != wht_id)
+                tax_lines.write({'withholding_tax_id': wht_id})
+                updated += len(tax_lines)
+            # Recalcular os totais das faturas do bloco e libertar a cache.
+            self.flush()
+            self.invalidate_cache()
+        _logger.info("Retenções padrão atribuídas a %s linhas de faturas.", updated)
+        return updated
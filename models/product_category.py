@@ -0,0 +1,13 @@
+from odoo import models, fields
+
+class ProductCategory(models.Model):
+    _inherit = 'product.category'
+
+    withholding_tax_type = fields.Selection([
+        ('ii', 'Imposto Industrial'),
+        ('ipu', 'Imposto Predial Urbano'),
+        ('iac', 'Imposto sobre Aplicação de Capitais')
+    ], string="Tipo de Retenção",
+        help="Tipo de retenção dos produtos desta categoria. Na atribuição em massa, "
+             "a retenção aplicada é a retenção padrão da empresa para este tipo."
+    )
@@ -0,0 +1,97 @@
+from collections import defaultdict
+
+from odoo import models, api
+
+class ReportPaymentReceipt(models.AbstractModel):
+    _name = 'report.account.report_payment_receipt'
+    _description = 'Recibo de Pagamento com Retenção na Fonte'
+
+    @api.model
+    def _get_reconciled_invoice_ids(self, payment_ids):
+        """
+        Devolve um dicionário {payment_id: [invoice_id]} com as faturas
+        reconciliadas com cada pagamento, obtido numa única consulta para
+        todos os pagamentos.
+        """
+        self.env['account.move.line'].flush(['move_id', 'account_internal_type'])
+        self.env['account.partial.reconcile'].flush(['debit_move_id', 'credit_move_id'])
+        self.env.cr.execute("""
+            SELECT DISTINCT pay.id, invoice_line.move_id
+              FROM account_payment pay
+              JOIN account_move_line pay_line ON pay_line.move_id = pay.move_id
+              JOIN account_partial_reconcile part ON part.debit_move_id = pay_line.id
+              JOIN account_move_line invoice_line ON invoice_line.id = part.credit_move_id
+             WHERE pay.id IN %(payment_ids)s
+               AND pay_line.account_internal_type IN ('receivable', 'payable')
+             UNION
+            SELECT DISTINCT pay.id, invoice_line.move_id
+              FROM account_payment pay
+              JOIN account_move_line pay_line ON pay_line.move_id = pay.move_id
+              JOIN account_partial_reconcile part ON part.credit_move_id = pay_line.id
+              JOIN account_move_line invoice_line ON invoice_line.id = part.debit_move_id
+             WHERE pay.id IN %(payment_ids)s
+               AND pay_line.account_internal_type IN ('receivable', 'payable')
+        """, {'payment_ids': tuple(payment_ids)})
+        invoice_ids_by_payment = defaultdict(list)
+        for payment_id, invoice_id in self.env.cr.fetchall():
+            invoice_ids_by_payment[payment_id].append(invoice_id)
+        return invoice_ids_by_payment
+
+    @api.model
+    def _get_withholding_receipts(self, payment_ids):
+        """
+        Devolve, para todos os pagamentos de uma só vez, um dicionário
+        {payment_id: {invoice_id: {'taxes': [...], 'withholding_amount': ...,
+        'net_amount': ...}}} com as retenções por taxa das faturas
+        reconciliadas, lidas do resumo de retenções já agregado.
+        """
+        invoice_ids_by_payment = self._get_reconciled_invoice_ids(payment_ids)
+        invoice_ids = {invoice_id for ids in invoice_ids_by_payment.values() for invoice_id in ids}
+        if not invoice_ids:
+            return {}
+
+        invoices = self.env['account.move'].search_read(
+            [('id', 'in', list(invoice_ids)), ('move_type', '!=', 'entry'), ('withholding_amount', '!=', 0)],
+            ['withholding_amount', 'net_amount'],
+        )
+        withholding_by_invoice = {
+            invoice['id']: {
+                'taxes': [],
+                'withholding_amount': invoice['withholding_amount'],
+                'net_amount': invoice['net_amount'],
+            }
+            for invoice in invoices
+        }
+        if not withholding_by_invoice:
+            return {}
+
+        self.env['withholding.summary'].flush()
+        self.env.cr.execute("""
+            SELECT summary.move_id, tax.name, summary.rate, summary.amount
+              FROM withholding_summary summary
+              JOIN withholding_tax tax ON tax.id = summary.withholding_tax_id
+             WHERE summary.move_id IN %s
+               AND summary.amount <> 0
+          ORDER BY summary.move_id, tax.name
+        """, [tuple(withholding_by_invoice)])
+        for invoice_id, tax_name, rate, amount in self.env.cr.fetchall():
+            withholding_by_invoice[invoice_id]['taxes'].append({'name': tax_name, 'rate': rate, 'amount': amount})
+
+        return {
+            payment_id: {
+                invoice_id: withholding_by_invoice[invoice_id]
+                for invoice_id in invoice_ids if invoice_id in withholding_by_invoice
+            }
+            for payment_id, invoice_ids in invoice_ids_by_payment.items()
+        }
+
+    @api.model
+    def _get_report_values(self, docids, data=None):
+        docs = self.env['account.payment'].browse(docids)
+        return {
+            'doc_ids': docids,
+            'doc_model': 'account.payment',
+            'docs': docs,
+            'data': data,
+            'withholding_receipts': self._get_withholding_receipts(docs.ids) if docs else {},
+        }
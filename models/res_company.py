@@ -0,0 +1,164 @@
+from bisect import bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date
+from types import MappingProxyType
+
+from odoo import models, fields, tools
+from odoo.exceptions import AccessError
+
+# Configuração de retenção de uma empresa, imutável, servida pela cache do ORM.
+WithholdingConfig = namedtuple('WithholdingConfig', [
+    'company_id', 'journal_id', 'consolidate', 'deferred', 'rounding', 'default_tax_ids', 'taxes',
+])
+
+class WithholdingTaxConfig(namedtuple('WithholdingTaxConfig', [
+    'id', 'name', 'code', 'tax_type', 'percentage', 'account_id', 'rate_dates', 'rates',
+])):
+    """
+    Configuração de uma retenção. `rate_dates` são as datas de início das
+    taxas do histórico, por ordem crescente, e `rates` os respetivos
+    (data de fim, percentagem), para pesquisa binária da taxa em vigor.
+    """
+    __slots__ = ()
+
+    def get_rate(self, rate_date):
+        """ Devolve a percentagem em vigor em `rate_date`, ou a taxa atual fora do histórico. """
+        index = bisect_right(self.rate_dates, rate_date) - 1
+        if index >= 0:
+            date_to, percentage = self.rates[index]
+            if not date_to or rate_date <= date_to:
+                return percentage
+        return self.percentage
+
+WITHHOLDING_CONFIG_FIELDS = {
+    'withholding_consolidate',
+    'withholding_deferred',
+    'withholding_journal_id',
+    'withholding_rounding',
+    'withholding_default_ii_id',
+    'withholding_default_ipu_id',
+    'withholding_default_iac_id',
+}
+
+def withholding_config_values(records, fnames):
+    """
+    Devolve os valores dos campos `fnames` de `records`, para comparar antes e
+    depois de uma escrita: a cache da configuração só é limpa se mudarem.
+    """
+    fnames = sorted(fnames)
+    return [tuple(record[fname] for fname in fnames) for record in records]
+
+def _rate_sort_key(rate):
+    return rate.date_from or date.min
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    withholding_consolidate = fields.Boolean(
+        string="Consolidar Retenções por Fatura",
+        help="Se ativo, é criado um único lançamento de retenção por fatura, "
+             "com uma linha por conta de retenção, em vez de um lançamento por cada taxa."
+    )
+    withholding_deferred = fields.Boolean(
+        string="Lançar Retenções em Diferido",
+        help="Se ativo, ao lançar as faturas as retenções ficam em fila e os respetivos "
+             "lançamentos são criados por uma tarefa agendada, em blocos."
+    )
+    withholding_journal_id = fields.Many2one(
+        'account.journal',
+        string="Diário de Retenções",
+        domain="[('type', '=', 'general'), ('company_id', '=', id)]",
+        help="Diário onde são criados os lançamentos de retenção. Se vazio, é "
+             "utilizado o primeiro diário de 'Operações Diversas' da empresa."
+    )
+    withholding_rounding = fields.Selection([
+        ('tax', 'Arredondar por taxa'),
+        ('line', 'Arredondar por linha'),
+    ], string="Arredondamento da Retenção", required=True, default='tax',
+        help="Por taxa: o valor retido é arredondado depois de somadas as linhas. "
+             "Por linha: o valor retido de cada linha é arredondado antes da soma.")
+    withholding_default_ii_id = fields.Many2one(
+        'withholding.tax',
+        string="Retenção Padrão (Imposto Industrial)",
+        domain="[('company_id', '=', id), ('tax_type', '=', 'ii')]"
+    )
+    withholding_default_ipu_id = fields.Many2one(
+        'withholding.tax',
+        string="Retenção Padrão (Imposto Predial Urbano)",
+        domain="[('company_id', '=', id), ('tax_type', '=', 'ipu')]"
+    )
+    withholding_default_iac_id = fields.Many2one(
+        'withholding.tax',
+        string="Retenção Padrão (Aplicação de Capitais)",
+        domain="[('company_id', '=', id), ('tax_type', '=', 'iac')]"
+    )
+
+    def write(self, vals):
+        with self._invalidate_withholding_config(self, WITHHOLDING_CONFIG_FIELDS.intersection(vals)):
+            return super().write(vals)
+
+    def _check_withholding_access(self):
+        """
+        Garante que as empresas em `self` estão entre as empresas permitidas
+        ao utilizador: o mapa, a declaração e os certificados de retenção são
+        lidos por SQL, sem as regras de acesso do ORM.
+        """
+        forbidden = self - self.env.companies
+        if forbidden:
+            raise AccessError("Não tem acesso aos dados de retenção da empresa %s."
+                              % ", ".join(forbidden.sudo().mapped('name')))
+
+    @contextmanager
+    def _invalidate_withholding_config(self, records, fnames):
+        """
+        Limpa a cache de `_get_withholding_config` se a escrita feita dentro do
+        bloco alterar algum dos campos `fnames` de `records`: as empresas, as
+        retenções, o histórico de taxas e os diários gerais fazem parte da
+        configuração em cache, mas as escritas que não lhe mudam os valores
+        não a invalidam.
+        """
+        before = withholding_config_values(records, fnames) if fnames and records else None
+        yield
+        if before is not None and withholding_config_values(records, fnames) != before:
+            self.env['res.company'].clear_caches()
+
+    @tools.ormcache('self.id')
+    def _get_withholding_config(self):
+        """
+        Devolve a configuração de retenção da empresa (diário, contas, taxas,
+        arredondamento) como um `WithholdingConfig` imutável. O resultado fica
+        em cache até ser alterada a empresa, uma retenção ou um diário.
+        """
+        self.ensure_one()
+        company = self.sudo()
+        journal = company.withholding_journal_id or self.env['account.journal'].sudo().search([
+            ('type', '=', 'general'),
+            ('company_id', '=', company.id),
+        ], limit=1)
+        taxes = self.env['withholding.tax'].sudo().search([('company_id', '=', company.id)])
+        return WithholdingConfig(
+            company_id=company.id,
+            journal_id=journal.id,
+            consolidate=company.withholding_consolidate,
+            deferred=company.withholding_deferred,
+            rounding=company.withholding_rounding,
+            default_tax_ids=MappingProxyType({
+                'ii': company.withholding_default_ii_id.id,
+                'ipu': company.withholding_default_ipu_id.id,
+                'iac': company.withholding_default_iac_id.id,
+            }),
+            taxes=MappingProxyType({
+                tax.id: WithholdingTaxConfig(
+                    id=tax.id,
+                    name=tax.name,
+                    code=tax.code,
+                    tax_type=tax.tax_type,
+                    percentage=tax.percentage,
+                    account_id=tax.account_id.id,
+                    rate_dates=tuple(rate.date_from or date.min for rate in tax.rate_ids.sorted(_rate_sort_key)),
+                    rates=tuple((rate.date_to, rate.percentage) for rate in tax.rate_ids.sorted(_rate_sort_key)),
+                )
+                for tax in taxes
+            }),
+        )
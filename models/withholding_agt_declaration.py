@@ -0,0 +1,129 @@
+from itertools import groupby
+
+from lxml import etree
+
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+
+# NIF utilizado para os beneficiários sem número de identificação fiscal.
+AGT_NO_VAT = '999999999'
+
+class WithholdingAgtDeclaration(models.AbstractModel):
+    _name = 'withholding.agt.declaration'
+    _description = 'Declaração de Retenção na Fonte (AGT)'
+
+    @api.model
+    def _get_declaration_lines_query(self, company_id, date_from, date_to):
+        """
+        Devolve a consulta (e respetivos parâmetros) com os valores retidos
+        por documento, na moeda da empresa, a partir do razão de retenções,
+        ordenados por tipo de imposto e NIF do beneficiário.
+        """
+        self.env['res.company'].browse(company_id)._check_withholding_access()
+        self.env['withholding.ledger'].flush()
+        self.env['account.move'].flush(['name', 'date', 'invoice_date'])
+        query = """
+            SELECT ledger.tax_type AS tax_type,
+                   COALESCE(NULLIF(TRIM(ledger.partner_vat), ''), %(no_vat)s) AS partner_vat,
+                   MIN(partner.name) AS partner_name,
+                   move.id AS move_id,
+                   move.name AS move_name,
+                   COALESCE(move.invoice_date, move.date) AS document_date,
+                   tax.code AS tax_code,
+                   SUM(ledger.base_company) AS base,
+                   SUM(ledger.amount_company) AS amount
+              FROM withholding_ledger ledger
+              JOIN account_move move ON move.id = ledger.move_id
+              JOIN withholding_tax tax ON tax.id = ledger.tax_id
+         LEFT JOIN res_partner partner ON partner.id = ledger.partner_id
+             WHERE ledger.company_id = %(company_id)s
+               AND ledger.date >= %(date_from)s
+               AND ledger.date <= %(date_to)s
+          GROUP BY ledger.tax_type, 2, move.id, move.name, 6, tax.code
+            HAVING SUM(ledger.amount_company) <> 0
+          ORDER BY ledger.tax_type, 2, 6, move.id, tax.code
+        """
+        params = {
+            'no_vat': AGT_NO_VAT,
+            'company_id': company_id,
+            'date_from': date_from,
+            'date_to': date_to,
+        }
+        return query, params
+
+    @api.model
+    def _format_amount(self, amount):
+        return '%.2f' % amount
+
+    @api.model
+    def _build_element(self, tag, children):
+        element = etree.Element(tag)
+        for child_tag, value in children:
+            etree.SubElement(element, child_tag).text = value
+        return element
+
+    @api.model
+    def _write_value(self, xf, tag, value):
+        element = etree.Element(tag)
+        element.text = value
+        xf.write(element)
+
+    @api.model
+    def _write_declaration(self, fp, company, date_from, date_to):
+        """
+        Escreve em `fp` a declaração de Retenção na Fonte da empresa para o
+        período, de forma incremental: os documentos são lidos da base de
+        dados em blocos e cada elemento é escrito e libertado de imediato,
+        sem construir a árvore XML completa em memória.
+        """
+        if not company.vat:
+            raise UserError("O NIF da empresa %s não está definido." % company.name)
+
+        query, params = self._get_declaration_lines_query(company.id, date_from, date_to)
+        rows = self.env['report.ao_withholding.report_withholding']._iter_query_rows(query, params)
+
+        totals = {'count': 0, 'base': 0.0, 'amount': 0.0}
+        with etree.xmlfile(fp, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('DeclaracaoRetencaoFonte'):
+                xf.write(self._build_element('Cabecalho', [
+                    ('NIFContribuinte', company.vat),
+                    ('NomeContribuinte', company.name),
+                    ('PeriodoInicio', fields.Date.to_string(date_from)),
+                    ('PeriodoFim', fields.Date.to_string(date_to)),
+                    ('DataGeracao', fields.Date.to_string(fields.Date.context_today(self))),
+                    ('Moeda', company.currency_id.name),
+                ]))
+                for tax_type, type_rows in groupby(rows, key=lambda row: row['tax_type']):
+                    type_totals = {'base': 0.0, 'amount': 0.0}
+                    with xf.element('Imposto', Tipo=tax_type):
+                        for partner_vat, partner_rows in groupby(type_rows, key=lambda row: row['partner_vat']):
+                            partner_totals = {'base': 0.0, 'amount': 0.0}
+                            with xf.element('Beneficiario'):
+                                first_row = next(partner_rows)
+                                self._write_value(xf, 'NIF', partner_vat)
+                                self._write_value(xf, 'Nome', (first_row['partner_name'] or '')[:200])
+                                for row in (first_row, *partner_rows):
+                                    xf.write(self._build_element('Documento', [
+                                        ('Numero', row['move_name']),
+                                        ('Data', fields.Date.to_string(row['document_date'])),
+                                        ('CodigoRetencao', row['tax_code']),
+                                        ('ValorBase', self._format_amount(row['base'])),
+                                        ('ValorRetido', self._format_amount(row['amount'])),
+                                    ]))
+                                    partner_totals['base'] += row['base']
+                                    partner_totals['amount'] += row['amount']
+                                    totals['count'] += 1
+                                self._write_value(xf, 'TotalBase', self._format_amount(partner_totals['base']))
+                                self._write_value(xf, 'TotalRetido', self._format_amount(partner_totals['amount']))
+                            type_totals['base'] += partner_totals['base']
+                            type_totals['amount'] += partner_totals['amount']
+                        self._write_value(xf, 'TotalBase', self._format_amount(type_totals['base']))
+                        self._write_value(xf, 'TotalRetido', self._format_amount(type_totals['amount']))
+                    totals['base'] += type_totals['base']
+                    totals['amount'] += type_totals['amount']
+                xf.write(self._build_element('Totais', [
+                    ('NumeroDocumentos', str(totals['count'])),
+                    ('TotalBase', self._format_amount(totals['base'])),
+                    ('TotalRetido', self._format_amount(totals['amount'])),
+                ]))
@@ -0,0 +1,55 @@
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+
+class WithholdingAssignWizard(models.TransientModel):
+    _name = 'withholding.assign.wizard'
+    _description = 'Wizard para Atribuição em Massa de Retenções'
+
+    company_id = fields.Many2one('res.company', string="Empresa", required=True,
+                                 default=lambda self: self.env.company)
+    move_ids = fields.Many2many(
+        'account.move',
+        string="Faturas",
+        default=lambda self: self._default_move_ids(),
+        help="Faturas de fornecedor em rascunho a tratar. Se vazio, são tratadas "
+             "todas as faturas de fornecedor em rascunho da empresa."
+    )
+    use_category = fields.Boolean(
+        string="Usar Categorias de Produto",
+        help="Se ativo, as linhas cujo produto pertence a uma categoria com tipo de "
+             "retenção recebem a retenção padrão da empresa para esse tipo, em vez "
+             "da retenção padrão do parceiro."
+    )
+    overwrite = fields.Boolean(
+        string="Substituir Retenções Existentes",
+        help="Se ativo, as linhas que já têm retenção também são atualizadas."
+    )
+
+    @api.model
+    def _default_move_ids(self):
+        if self.env.context.get('active_model') != 'account.move':
+            return False
+        return [(6, 0, self.env.context.get('active_ids', []))]
+
+    def _get_line_domain(self):
+        self.ensure_one()
+        domain = [
+            ('move_id.state', '=', 'draft'),
+            ('move_id.move_type', 'in', ('in_invoice', 'in_refund')),
+            ('company_id', '=', self.company_id.id),
+            ('exclude_from_invoice_tab', '=', False),
+            ('display_type', '=', False),
+        ]
+        if self.move_ids:
+            domain.append(('move_id', 'in', self.move_ids.ids))
+        if not self.overwrite:
+            domain.append(('withholding_tax_id', '=', False))
+        return domain
+
+    def action_apply(self):
+        self.ensure_one()
+        lines = self.env['account.move.line'].search(self._get_line_domain(), order='id')
+        if not lines:
+            raise UserError("Não foram encontradas linhas de faturas em rascunho a que aplicar retenções.")
+        lines._apply_withholding_defaults(use_category=self.use_category, overwrite=self.overwrite)
+        return {'type': 'ir.actions.act_window_close'}
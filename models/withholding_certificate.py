@@ -0,0 +1,135 @@
+import io
+import logging
+import re
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.utils import PdfReadError
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+class ReportWithholdingCertificate(models.AbstractModel):
+    _name = 'report.ao_withholding.report_withholding_certificate'
+    _description = 'Certificado de Retenção na Fonte'
+
+    @api.model
+    def _get_certificate_rows(self, company_id, date_from, date_to, partner_ids):
+        """
+        Devolve um dicionário {partner_id: [linhas]} com os valores retidos a
+        cada parceiro no período, na moeda da empresa, obtido do razão de
+        retenções numa única consulta para todos os parceiros indicados.
+        """
+        self.env['res.company'].browse(company_id)._check_withholding_access()
+        self.env['withholding.ledger'].flush()
+        self.env['account.move'].flush(['name', 'date', 'invoice_date'])
+        self.env.cr.execute("""
+            SELECT ledger.partner_id AS partner_id,
+                   move.name AS move_name,
+                   COALESCE(move.invoice_date, move.date) AS document_date,
+                   tax.name AS tax_name,
+                   SUM(ledger.base_company) AS base,
+                   SUM(ledger.amount_company) AS amount
+              FROM withholding_ledger ledger
+              JOIN account_move move ON move.id = ledger.move_id
+              JOIN withholding_tax tax ON tax.id = ledger.tax_id
+             WHERE ledger.company_id = %(company_id)s
+               AND ledger.date >= %(date_from)s
+               AND ledger.date <= %(date_to)s
+               AND ledger.partner_id IN %(partner_ids)s
+          GROUP BY ledger.partner_id, move.id, move.name, 3, tax.id, tax.name
+            HAVING SUM(ledger.amount_company) <> 0
+          ORDER BY ledger.partner_id, 3, move.name, tax.name
+        """, {
+            'company_id': company_id,
+            'date_from': date_from,
+            'date_to': date_to,
+            'partner_ids': tuple(partner_ids),
+        })
+        rows_by_partner = {partner_id: [] for partner_id in partner_ids}
+        for row in self.env.cr.dictfetchall():
+            rows_by_partner[row['partner_id']].append(row)
+        return rows_by_partner
+
+    @api.model
+    def _get_certificate_filename(self, partner):
+        # O id do parceiro garante nomes únicos no arquivo, mesmo com NIF ou nome repetidos.
+        return 'certificado_retencao_%s_%s_%s.pdf' % (
+            partner.vat or 'sem_nif', re.sub(r'[^\w-]+', '_', partner.name or ''), partner.id)
+
+    @api.model
+    def _render_certificates(self, partner_ids, data):
+        """
+        Gera os certificados dos parceiros do bloco com uma única execução do
+        wkhtmltopdf e divide o PDF resultante num certificado por parceiro.
+        Se não for possível dividir o PDF, é devolvido um único ficheiro com
+        os certificados de todo o bloco.
+
+        :return: lista de (nome do ficheiro, conteúdo PDF)
+        """
+        date_from = fields.Date.to_date(data['date_from'])
+        date_to = fields.Date.to_date(data['date_to'])
+        rows_by_partner = self._get_certificate_rows(data['company_id'], date_from, date_to, partner_ids)
+        partners = self.env['res.partner'].browse(partner_ids)
+        partners.read(['name', 'vat'])
+
+        report = self.env.ref('ao_withholding.action_report_withholding_certificate')
+        pdf_content, __ = report._render_qweb_pdf(partners.ids, data=dict(data, rows_by_partner=rows_by_partner))
+        pdf_parts = self._split_certificate_pdf(pdf_content, len(partners))
+        if pdf_parts is None:
+            filename = 'certificados_retencao_%s-%s.pdf' % (partners[0].id, partners[-1].id)
+            return [(filename, pdf_content)]
+        return [
+            (self._get_certificate_filename(partner), part)
+            for partner, part in zip(partners, pdf_parts)
+        ]
+
+    @api.model
+    def _split_certificate_pdf(self, pdf_content, count):
+        """
+        Divide um PDF com `count` certificados pelos marcadores de primeiro
+        nível gerados pelo wkhtmltopdf (o título de cada certificado), tal como
+        o Odoo faz para guardar os anexos de relatórios com vários registos.
+
+        :return: lista de `count` PDFs, ou None se os marcadores não corresponderem aos certificados
+        """
+        try:
+            reader = PdfFileReader(io.BytesIO(pdf_content), strict=False)
+            outlines = [outline for outline in reader.getOutlines() if not isinstance(outline, list)]
+            start_pages = sorted({reader.getDestinationPageNumber(outline) for outline in outlines})
+            page_count = reader.getNumPages()
+        except (PdfReadError, KeyError, ValueError, TypeError):
+            _logger.warning("Certificados de retenção: não foi possível dividir o PDF por parceiro.")
+            return None
+        if len(start_pages) != count or not start_pages or start_pages[0] != 0:
+            return None
+
+        parts = []
+        for index, first_page in enumerate(start_pages):
+            last_page = start_pages[index + 1] if index + 1 < len(start_pages) else page_count
+            writer = PdfFileWriter()
+            for page_number in range(first_page, last_page):
+                writer.addPage(reader.getPage(page_number))
+            stream = io.BytesIO()
+            writer.write(stream)
+            parts.append(stream.getvalue())
+        return parts
+
+    @api.model
+    def _get_report_values(self, docids, data=None):
+        data = data or {}
+        company = self.env['res.company'].browse(data['company_id'])
+        company._check_withholding_access()
+        date_from = fields.Date.to_date(data['date_from'])
+        date_to = fields.Date.to_date(data['date_to'])
+        rows_by_partner = data.get('rows_by_partner') or self._get_certificate_rows(
+            company.id, date_from, date_to, docids)
+        return {
+            'doc_ids': docids,
+            'doc_model': 'res.partner',
+            'docs': self.env['res.partner'].browse(docids),
+            'company': company,
+            'date_from': date_from,
+            'date_to': date_to,
+            'rows_by_partner': rows_by_partner,
+        }
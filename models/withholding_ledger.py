@@ -0,0 +1,74 @@
+from odoo import models, fields, tools
+
+class WithholdingLedger(models.Model):
+    _name = 'withholding.ledger'
+    _description = 'Razão de Retenções na Fonte'
+    _order = 'date desc, id desc'
+
+    move_id = fields.Many2one('account.move', string="Fatura", required=True, index=True, ondelete='cascade')
+    withholding_move_id = fields.Many2one('account.move', string="Lançamento de Retenção", index=True, ondelete='set null')
+    company_id = fields.Many2one('res.company', string="Empresa", required=True)
+    date = fields.Date(string="Data", required=True)
+    partner_id = fields.Many2one('res.partner', string="Parceiro")
+    partner_vat = fields.Char(string="NIF Parceiro")
+    tax_id = fields.Many2one('withholding.tax', string="Retenção na Fonte", required=True, ondelete='restrict')
+    tax_type = fields.Selection(
+        selection=lambda self: self.env['withholding.tax']._fields['tax_type'].selection,
+        string="Tipo de Imposto",
+        required=True
+    )
+    currency_id = fields.Many2one('res.currency', string="Moeda", required=True)
+    base = fields.Monetary(string="Valor Base")
+    amount = fields.Monetary(string="Valor Retido")
+    company_currency_id = fields.Many2one(related='company_id.currency_id', string="Moeda da Empresa")
+    base_company = fields.Monetary(string="Valor Base (Moeda da Empresa)", currency_field='company_currency_id')
+    amount_company = fields.Monetary(string="Valor Retido (Moeda da Empresa)", currency_field='company_currency_id')
+    is_reversal = fields.Boolean(
+        string="Estorno",
+        help="Movimento que anula uma retenção anterior, criado quando a fatura "
+             "ou o lançamento de retenção volta a rascunho ou é cancelado."
+    )
+
+    def init(self):
+        tools.create_index(self._cr, 'withholding_ledger_company_date_tax_index',
+                           self._table, ['company_id', 'date', 'tax_id'])
+        tools.create_index(self._cr, 'withholding_ledger_partner_date_index',
+                           self._table, ['partner_id', 'date'])
+
+    def _reverse_entries(self):
+        """
+        Acrescenta ao razão os movimentos de estorno que anulam o saldo dos
+        movimentos em `self`, agrupado por fatura, lançamento de retenção e taxa.
+        """
+        balances = {}
+        for entry in self:
+            key = (entry.move_id, entry.withholding_move_id, entry.tax_id)
+            if key not in balances:
+                balances[key] = {'entry': entry, 'base': 0.0, 'amount': 0.0, 'base_company': 0.0, 'amount_company': 0.0}
+            balances[key]['base'] += entry.base
+            balances[key]['amount'] += entry.amount
+            balances[key]['base_company'] += entry.base_company
+            balances[key]['amount_company'] += entry.amount_company
+
+        vals_list = []
+        for balance in balances.values():
+            entry = balance['entry']
+            if entry.currency_id.is_zero(balance['amount']) and entry.currency_id.is_zero(balance['base']):
+                continue
+            vals_list.append({
+                'move_id': entry.move_id.id,
+                'withholding_move_id': entry.withholding_move_id.id,
+                'company_id': entry.company_id.id,
+                'date': entry.date,
+                'partner_id': entry.partner_id.id,
+                'partner_vat': entry.partner_vat,
+                'tax_id': entry.tax_id.id,
+                'tax_type': entry.tax_type,
+                'currency_id': entry.currency_id.id,
+                'base': -balance['base'],
+                'amount': -balance['amount'],
+                'base_company': -balance['base_company'],
+                'amount_company': -balance['amount_company'],
+                'is_reversal': True,
+            })
+        return self.create(vals_list)
@@ -0,0 +1,136 @@
+import functools
+import logging
+import random
+import threading
+import time
+
+from odoo import models, fields, tools
+
+_logger = logging.getLogger(__name__)
+
+# Operações medidas em curso na thread atual: as chamadas encaixadas da mesma
+# operação (ex: o `_post` dos lançamentos de retenção dentro do `_post` das
+# faturas) não são medidas à parte, para não contar duas vezes o mesmo tempo.
+_profiled_operations = threading.local()
+
+# Retenção por omissão das medições: dias e número máximo de registos.
+PERF_STAT_RETENTION_DAYS = 30
+PERF_STAT_MAX_ROWS = 100000
+
+
+def withholding_profiled(operation):
+    """
+    Decorador que mede, por amostragem, o tempo de execução, o número de
+    consultas SQL e o número de registos de um método de recordset, e os
+    regista em `withholding.perf.stat`. A taxa de amostragem é definida pelo
+    parâmetro de sistema `ao_withholding.perf_sample_rate` (0 desativa).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            operations = _profiled_operations.__dict__.setdefault('operations', set())
+            if operation in operations:
+                return method(self, *args, **kwargs)
+
+            operations.add(operation)
+            try:
+                sample_rate = self.env['withholding.perf.stat']._get_sample_rate()
+                if not sample_rate or random.random() >= sample_rate:
+                    return method(self, *args, **kwargs)
+
+                query_count = self.env.cr.sql_log_count
+                start = time.perf_counter()
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    self.env['withholding.perf.stat']._record(
+                        operation,
+                        (time.perf_counter() - start) * 1000,
+                        self.env.cr.sql_log_count - query_count,
+                        len(self),
+                    )
+            finally:
+                operations.discard(operation)
+        return wrapper
+    return decorator
+
+
+class WithholdingPerfStat(models.Model):
+    _name = 'withholding.perf.stat'
+    _description = 'Estatística de Desempenho da Retenção na Fonte'
+    _order = 'id desc'
+
+    operation = fields.Char(string="Operação", required=True, index=True)
+    duration_ms = fields.Float(string="Duração (ms)")
+    query_count = fields.Integer(string="Consultas SQL")
+    record_count = fields.Integer(string="Registos")
+    company_id = fields.Many2one('res.company', string="Empresa")
+
+    def _get_sample_rate(self):
+        # `get_param` é servido pela cache do ORM: não consulta a base de dados em cada chamada.
+        try:
+            return float(self.env['ir.config_parameter'].sudo().get_param('ao_withholding.perf_sample_rate', 0))
+        except ValueError:
+            return 0.0
+
+    def _record(self, operation, duration_ms, query_count, record_count):
+        """
+        Regista uma medição diretamente por SQL, para não interferir com o
+        ORM (a medição pode ocorrer durante um recálculo de campos).
+        """
+        self.env.cr.execute("""
+            INSERT INTO withholding_perf_stat
+                (operation, duration_ms, query_count, record_count, company_id,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+        """, [operation, duration_ms, query_count, record_count, self.env.company.id, self.env.uid, self.env.uid])
+        _logger.debug(
+            "withholding.perf operation=%s duration_ms=%.1f queries=%d records=%d",
+            operation, duration_ms, query_count, record_count)
+
+    def _cron_vacuum(self):
+        """
+        Apaga as medições com mais de `ao_withholding.perf_retention_days` dias
+        e, acima de `ao_withholding.perf_max_rows` medições, as mais antigas.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        retention_days = int(params.get_param('ao_withholding.perf_retention_days', PERF_STAT_RETENTION_DAYS))
+        max_rows = int(params.get_param('ao_withholding.perf_max_rows', PERF_STAT_MAX_ROWS))
+        self.env.cr.execute("""
+            DELETE FROM withholding_perf_stat
+             WHERE create_date < (now() at time zone 'UTC') - make_interval(days => %s)
+                OR id <= (SELECT MAX(id) FROM withholding_perf_stat) - %s
+        """, [retention_days, max_rows])
+        _logger.info("withholding.perf: %s medições antigas apagadas.", self.env.cr.rowcount)
+
+
+class WithholdingPerfStatReport(models.Model):
+    _name = 'withholding.perf.stat.report'
+    _description = 'Resumo de Desempenho da Retenção na Fonte'
+    _auto = False
+    _order = 'operation'
+
+    operation = fields.Char(string="Operação", readonly=True)
+    call_count = fields.Integer(string="Chamadas", readonly=True)
+    duration_p50 = fields.Float(string="Duração p50 (ms)", readonly=True)
+    duration_p95 = fields.Float(string="Duração p95 (ms)", readonly=True)
+    query_p50 = fields.Float(string="Consultas p50", readonly=True)
+    query_p95 = fields.Float(string="Consultas p95", readonly=True)
+    record_avg = fields.Float(string="Registos (média)", readonly=True)
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute("""
+            CREATE OR REPLACE VIEW %s AS (
+                SELECT MIN(stat.id) AS id,
+                       stat.operation AS operation,
+                       COUNT(*) AS call_count,
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY stat.duration_ms) AS duration_p50,
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY stat.duration_ms) AS duration_p95,
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY stat.query_count) AS query_p50,
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY stat.query_count) AS query_p95,
+                       AVG(stat.record_count) AS record_avg
+                  FROM withholding_perf_stat stat
+              GROUP BY stat.operation
+            )
+        """ % self._table)
@@ -0,0 +1,131 @@
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# Número de tentativas antes de uma fatura ficar com a retenção em erro.
+WITHHOLDING_QUEUE_MAX_ATTEMPTS = 3
+
+class WithholdingQueue(models.Model):
+    _name = 'withholding.queue'
+    _description = 'Fila de Lançamentos de Retenção'
+    _order = 'id'
+
+    move_id = fields.Many2one('account.move', string="Fatura", required=True, index=True, ondelete='cascade')
+    company_id = fields.Many2one(related='move_id.company_id', store=True)
+    state = fields.Selection([
+        ('pending', 'Pendente'),
+        ('done', 'Processado'),
+        ('failed', 'Com Erro'),
+    ], string="Estado", required=True, default='pending', index=True)
+    attempts = fields.Integer(string="Tentativas")
+    error = fields.Text(string="Erro")
+    date_done = fields.Datetime(string="Processado em")
+
+    _sql_constraints = [
+        ('move_uniq', 'unique(move_id)', "Cada fatura só pode estar uma vez na fila de retenções."),
+    ]
+
+    @api.model
+    def _enqueue(self, moves):
+        """
+        Coloca as faturas na fila. As faturas que já lá estavam (ex: lançadas
+        de novo depois de voltarem a rascunho) voltam ao estado pendente.
+        """
+        existing = self.search([('move_id', 'in', moves.ids)])
+        existing.write({'state': 'pending', 'attempts': 0, 'error': False, 'date_done': False})
+        self.create([{'move_id': move.id} for move in moves - existing.move_id])
+        moves.write({'withholding_state': 'pending'})
+
+    @api.model
+    def _dequeue(self, moves):
+        """
+        Retira da fila as faturas que voltaram a rascunho antes de processadas.
+        """
+        pending = self.search([('move_id', 'in', moves.ids), ('state', '!=', 'done')])
+        if pending:
+            pending.move_id.write({'withholding_state': False})
+            pending.unlink()
+
+    @api.model
+    def _cron_process_queue(self, chunk_size=None, auto_commit=True):
+        """
+        Processa a fila em blocos de `chunk_size` faturas, com um commit por
+        bloco. Os blocos são obtidos com `FOR UPDATE SKIP LOCKED`, pelo que
+        vários workers podem processar a fila em simultâneo, e percorridos por
+        ordem de id a partir do último tratado: as faturas que ficam pendentes
+        após um erro só são repetidas na execução seguinte.
+        """
+        if chunk_size is None:
+            chunk_size = int(self.env['ir.config_parameter'].sudo().get_param('ao_withholding.queue_chunk_size', 200))
+        last_id = 0
+        done = 0
+        while True:
+            self.env.cr.execute("""
+                SELECT id
+                  FROM withholding_queue
+                 WHERE state = 'pending'
+                   AND id > %s
+              ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            """, [last_id, chunk_size])
+            ids = [row[0] for row in self.env.cr.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+            done += len(ids)
+            self.browse(ids)._process()
+            if auto_commit:
+                self.env.cr.commit()
+            _logger.info("Fila de retenções: %s faturas processadas.", done)
+
+    def _process(self):
+        """
+        Cria os lançamentos de retenção das faturas do bloco. Se o bloco falhar,
+        as faturas são processadas uma a uma para isolar as que têm erro.
+        """
+        try:
+            with self.env.cr.savepoint():
+                self._process_entries()
+        except Exception:
+            self.invalidate_cache()
+            for entry in self:
+                try:
+                    with self.env.cr.savepoint():
+                        entry._process_entries()
+                except Exception as e:
+                    self.invalidate_cache()
+                    entry._mark_failed(e)
+
+    def _process_entries(self):
+        """
+        Processamento idempotente: as faturas que já têm lançamentos de retenção
+        lançados não voltam a ser processadas.
+        """
+        moves = self.move_id.filtered(lambda move: move.state == 'posted')
+        already_done = self.env['account.move'].search([
+            ('withholding_origin_id', 'in', moves.ids),
+            ('state', '=', 'posted'),
+        ]).withholding_origin_id
+        (moves - already_done)._create_withholding_entries()
+        self.write({'state': 'done', 'error': False, 'date_done': fields.Datetime.now()})
+        moves.write({'withholding_state': 'done'})
+
+    def _mark_failed(self, error):
+        self.ensure_one()
+        _logger.warning("Erro ao criar os lançamentos de retenção da fatura %s: %s", self.move_id.display_name, error)
+        attempts = self.attempts + 1
+        failed = attempts >= WITHHOLDING_QUEUE_MAX_ATTEMPTS
+        self.write({
+            'attempts': attempts,
+            'error': str(error),
+            'state': 'failed' if failed else 'pending',
+        })
+        if failed:
+            self.move_id.write({'withholding_state': 'failed'})
+
+    def action_retry(self):
+        self.write({'state': 'pending', 'attempts': 0, 'error': False})
+        self.move_id.write({'withholding_state': 'pending'})
@@ -0,0 +1,183 @@
+import csv
+import io
+import uuid
+
+import xlsxwriter
+
+from odoo import models, fields, api
+
+from .account_move import WITHHOLDING_COMPANY_RATE_SQL
+
+# Número de linhas lidas de cada vez do cursor do lado do servidor.
+EXPORT_CHUNK_SIZE = 5000
+
+EXPORT_COLUMNS = [
+    ('date', "Data"),
+    ('move_name', "Nº Fatura"),
+    ('partner_name', "Parceiro"),
+    ('partner_vat', "NIF Parceiro"),
+    ('tax_code', "Código"),
+    ('tax_name', "Retenção"),
+    ('tax_type', "Tipo de Imposto"),
+    ('base', "Base"),
+    ('rate', "Taxa (%)"),
+    ('amount', "Valor Retido"),
+]
+
+class ReportWithholding(models.AbstractModel):
+    _name = 'report.ao_withholding.report_withholding'
+    _description = 'Mapa de Retenção na Fonte'
+
+    @api.model
+    def _get_report_lines_query(self, company_id, date_from, date_to):
+        """
+        Devolve a consulta (e respetivos parâmetros) que lista uma linha por
+        fatura lançada e por taxa de retenção, com a taxa efetivamente aplicada
+        e os dados do parceiro, a partir do resumo de retenções já agregado.
+        A base e o valor retido são convertidos para a moeda da empresa à taxa
+        com que a fatura foi contabilizada.
+        """
+        self.env['res.company'].browse(company_id)._check_withholding_access()
+        self.env['withholding.summary'].flush()
+        self.env['account.move'].flush([
+            'name', 'date', 'invoice_date', 'state', 'company_id', 'partner_id', 'amount_total', 'amount_total_signed',
+        ])
+        query = """
+            SELECT summary.id AS summary_id,
+                   move.id AS move_id,
+                   move.invoice_date AS invoice_date,
+                   move.date AS date,
+                   move.name AS move_name,
+                   partner.name AS partner_name,
+                   partner.vat AS partner_vat,
+                   tax.code AS tax_code,
+                   tax.name AS tax_name,
+                   tax.tax_type AS tax_type,
+                   summary.rate AS rate,
+                   ROUND(summary.base * %s / cur.rounding) * cur.rounding AS base,
+                   ROUND(summary.amount * %s / cur.rounding) * cur.rounding AS amount
+              FROM withholding_summary summary
+              JOIN account_move move ON move.id = summary.move_id
+              JOIN res_company company ON company.id = move.company_id
+              JOIN res_currency cur ON cur.id = company.currency_id
+              JOIN withholding_tax tax ON tax.id = summary.withholding_tax_id
+         LEFT JOIN res_partner partner ON partner.id = move.partner_id
+             WHERE move.state = 'posted'
+               AND move.company_id = %%(company_id)s
+               AND move.date >= %%(date_from)s
+               AND move.date <= %%(date_to)s
+               AND summary.amount <> 0
+        """ % (WITHHOLDING_COMPANY_RATE_SQL, WITHHOLDING_COMPANY_RATE_SQL)
+        params = {
+            'company_id': company_id,
+            'date_from': date_from,
+            'date_to': date_to,
+        }
+        return query, params
+
+    @api.model
+    def _get_report_groups(self, company_id, date_from, date_to):
+        """
+        Agrupa as linhas do mapa por tipo de imposto, com os respetivos subtotais.
+        """
+        query, params = self._get_report_lines_query(company_id, date_from, date_to)
+        self.env.cr.execute(query + " ORDER BY tax.tax_type, move.date, move.name, summary.id", params)
+
+        tax_type_labels = dict(self.env['withholding.tax']._fields['tax_type']._description_selection(self.env))
+        groups = []
+        for row in self.env.cr.dictfetchall():
+            if not groups or groups[-1]['tax_type'] != row['tax_type']:
+                groups.append({
+                    'tax_type': row['tax_type'],
+                    'name': tax_type_labels.get(row['tax_type'], row['tax_type']),
+                    'lines': [],
+                    'base': 0.0,
+                    'amount': 0.0,
+                })
+            group = groups[-1]
+            group['lines'].append(row)
+            group['base'] += row['base']
+            group['amount'] += row['amount']
+        return groups
+
+    @api.model
+    def _iter_query_rows(self, query, params, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Percorre o resultado de `query` através de um cursor SQL do lado do
+        servidor (DECLARE/FETCH no cursor da transação), lendo `chunk_size`
+        linhas de cada vez, para que a memória utilizada não dependa do número
+        de linhas do período.
+        """
+        name = 'withholding_%s' % uuid.uuid4().hex
+        self.env.cr.execute("DECLARE %s NO SCROLL CURSOR FOR " % name + query, params)
+        try:
+            while True:
+                self.env.cr.execute("FETCH FORWARD %s FROM %s" % (int(chunk_size), name))
+                rows = self.env.cr.dictfetchall()
+                if not rows:
+                    break
+                yield from rows
+        except GeneratorExit:
+            # Leitura interrompida pelo chamador: libertar já o cursor.
+            self.env.cr.execute("CLOSE %s" % name)
+            raise
+        self.env.cr.execute("CLOSE %s" % name)
+
+    @api.model
+    def _iter_export_rows(self, company_id, date_from, date_to):
+        query, params = self._get_report_lines_query(company_id, date_from, date_to)
+        return self._iter_query_rows(query + " ORDER BY move.date, summary.id", params)
+
+    @api.model
+    def _write_csv(self, fp, company_id, date_from, date_to):
+        writer_fp = io.TextIOWrapper(fp, encoding='utf-8-sig', newline='')
+        writer = csv.writer(writer_fp, delimiter=';')
+        writer.writerow([label for __, label in EXPORT_COLUMNS])
+        for row in self._iter_export_rows(company_id, date_from, date_to):
+            writer.writerow([row[key] for key, __ in EXPORT_COLUMNS])
+        writer_fp.flush()
+        # Devolver o ficheiro binário sem o fechar juntamente com o wrapper.
+        writer_fp.detach()
+
+    @api.model
+    def _write_xlsx(self, fp, company_id, date_from, date_to):
+        # Em modo `constant_memory` cada linha é escrita diretamente em disco.
+        workbook = xlsxwriter.Workbook(fp, {'constant_memory': True})
+        worksheet = workbook.add_worksheet("Retenções")
+        header_format = workbook.add_format({'bold': True})
+        date_format = workbook.add_format({'num_format': 'dd/mm/yyyy'})
+        amount_format = workbook.add_format({'num_format': '#,##0.00'})
+        formats = {'date': date_format, 'base': amount_format, 'amount': amount_format}
+
+        for col, (__, label) in enumerate(EXPORT_COLUMNS):
+            worksheet.write(0, col, label, header_format)
+        for row_index, row in enumerate(self._iter_export_rows(company_id, date_from, date_to), start=1):
+            for col, (key, __) in enumerate(EXPORT_COLUMNS):
+                value = row[key]
+                if value is None:
+                    continue
+                if key == 'date':
+                    worksheet.write_datetime(row_index, col, fields.Datetime.to_datetime(value), date_format)
+                else:
+                    worksheet.write(row_index, col, value, formats.get(key))
+        workbook.close()
+
+    @api.model
+    def _get_report_values(self, docids, data=None):
+        data = data or {}
+        company = self.env['res.company'].browse(data['company_id'])
+        company._check_withholding_access()
+        date_from = fields.Date.to_date(data['date_from'])
+        date_to = fields.Date.to_date(data['date_to'])
+        groups = self._get_report_groups(company.id, date_from, date_to)
+        return {
+            'doc_ids': docids,
+            'doc_model': 'withholding.report.wizard',
+            'docs': self.env['withholding.report.wizard'].browse(docids),
+            'company': company,
+            'date_from': date_from,
+            'date_to': date_to,
+            'groups': groups,
+            'total_base': sum(group['base'] for group in groups),
+            'total_withholding': sum(group['amount'] for group in groups),
+        }
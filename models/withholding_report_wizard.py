@@ -1,4 +1,27 @@
+import base64
+import logging
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from odoo import models, fields, api
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+from .withholding_perf_stat import withholding_profiled
+
+_logger = logging.getLogger(__name__)
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'agt_xml': 'application/xml',
+}
+EXPORT_EXTENSIONS = {
+    'csv': 'csv',
+    'xlsx': 'xlsx',
+    'agt_xml': 'xml',
+}
 
 class WithholdingReportWizard(models.TransientModel):
     _name = 'withholding.report.wizard'
@@ -8,26 +31,162 @@ class WithholdingReportWizard(models.TransientModel):
     date_to = fields.Date(string="Data de Fim", required=True)
     company_id = fields.Many2one('res.company', string="Empresa", required=True,
                                  default=lambda self: self.env.company)
+    export_format = fields.Selection([
+        ('xlsx', 'Excel (XLSX)'),
+        ('csv', 'CSV'),
+        ('agt_xml', 'Declaração AGT (XML)'),
+    ], string="Formato de Exportação", required=True, default='xlsx')
+    partner_ids = fields.Many2many(
+        'res.partner',
+        string="Parceiros",
+        help="Parceiros para os quais emitir certificados. Se vazio, são emitidos "
+             "certificados para todos os parceiros com retenções no período."
+    )
+
+    def _get_summary_domain(self):
+        self.ensure_one()
+        return [
+            ('move_id.date', '>=', self.date_from),
+            ('move_id.date', '<=', self.date_to),
+            ('move_id.state', '=', 'posted'),
+            ('move_id.company_id', '=', self.company_id.id),
+            ('amount', '!=', 0),
+        ]
 
+    @withholding_profiled('print_report')
     def print_report(self):
+        self.ensure_one()
+        if not self.env['withholding.summary'].search_count(self._get_summary_domain()):
+            raise UserError("Não foram encontradas faturas com retenção no período selecionado.")
+
+        # Os dados enviados ao relatório têm de ser serializáveis: as linhas
+        # são obtidas pelo modelo do relatório numa única consulta agregada.
+        data = {
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+            'company_id': self.company_id.id,
+        }
+        return self.env.ref('ao_withholding.action_report_withholding').report_action(self, data=data)
+
+    def action_export(self):
+        self.ensure_one()
+        if not self.env['withholding.summary'].search_count(self._get_summary_domain()):
+            raise UserError("Não foram encontradas faturas com retenção no período selecionado.")
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/ao_withholding/export/%s' % self.id,
+            'target': 'self',
+        }
+
+    def _export_to_file(self):
+        """
+        Escreve o mapa de retenções num ficheiro temporário no formato escolhido,
+        lendo as linhas da base de dados em blocos.
+
+        :return: (ficheiro posicionado no início, nome do ficheiro, mimetype)
+        """
+        self.ensure_one()
+        self.company_id._check_withholding_access()
+        report = self.env['report.ao_withholding.report_withholding']
+        fp = tempfile.TemporaryFile()
+        if self.export_format == 'csv':
+            report._write_csv(fp, self.company_id.id, self.date_from, self.date_to)
+        elif self.export_format == 'agt_xml':
+            self.env['withholding.agt.declaration']._write_declaration(fp, self.company_id, self.date_from, self.date_to)
+        else:
+            report._write_xlsx(fp, self.company_id.id, self.date_from, self.date_to)
+        fp.seek(0)
+        filename = '%s_%s_%s.%s' % (
+            'declaracao_retencoes' if self.export_format == 'agt_xml' else 'mapa_retencoes',
+            fields.Date.to_string(self.date_from),
+            fields.Date.to_string(self.date_to),
+            EXPORT_EXTENSIONS[self.export_format],
+        )
+        return fp, filename, EXPORT_MIMETYPES[self.export_format]
+
+    def _get_certificate_partner_ids(self):
+        """
+        Devolve os ids dos parceiros com retenções no período, lidos do razão
+        de retenções, limitados aos parceiros escolhidos no assistente.
+        """
         self.ensure_one()
         domain = [
+            ('company_id', '=', self.company_id.id),
             ('date', '>=', self.date_from),
             ('date', '<=', self.date_to),
-            ('withholding_amount', '>', 0),
-            ('state', '=', 'posted'),
-            ('company_id', '=', self.company_id.id),
+            ('partner_id', '!=', False),
         ]
-        invoices = self.env['account.move'].search(domain)
+        if self.partner_ids:
+            domain.append(('partner_id', 'in', self.partner_ids.ids))
+        groups = self.env['withholding.ledger'].read_group(domain, ['amount'], ['partner_id'])
+        return sorted(
+            group['partner_id'][0] for group in groups
+            if not self.company_id.currency_id.is_zero(group['amount'])
+        )
 
-        if not invoices:
-            raise models.UserError("Não foram encontradas faturas com retenção no período selecionado.")
+    def action_print_certificates(self):
+        """
+        Emite um certificado de retenção por parceiro e devolve-os num ficheiro ZIP.
+        Os parceiros são divididos em blocos, processados em paralelo por um
+        conjunto de workers, cada um com o seu cursor.
+        """
+        self.ensure_one()
+        self.company_id._check_withholding_access()
+        partner_ids = self._get_certificate_partner_ids()
+        if not partner_ids:
+            raise UserError("Não foram encontradas retenções no período selecionado.")
 
+        params = self.env['ir.config_parameter'].sudo()
+        chunk_size = int(params.get_param('ao_withholding.certificate_chunk_size', 100))
+        workers = int(params.get_param('ao_withholding.certificate_workers', 4))
         data = {
-            'doc_ids': invoices.ids,
-            'doc_model': 'account.move',
-            'date_from': self.date_from,
-            'date_to': self.date_to,
-            'company': self.company_id,
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+            'company_id': self.company_id.id,
         }
-        return self.env.ref('ao_withholding.action_report_withholding').report_action(self, data=data)
\ No newline at end of file
+        chunks = list(split_every(chunk_size, partner_ids, list))
+
+        with tempfile.TemporaryFile() as fp:
+            with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for certificates in self._iter_rendered_certificates(chunks, data, workers):
+                    for filename, pdf_content in certificates:
+                        archive.writestr(filename, pdf_content)
+            fp.seek(0)
+            attachment = self.env['ir.attachment'].create({
+                'name': 'certificados_retencao_%s_%s.zip' % (data['date_from'], data['date_to']),
+                'datas': base64.b64encode(fp.read()),
+                'mimetype': 'application/zip',
+                'res_model': self._name,
+                'res_id': self.id,
+            })
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/web/content/%s?download=true' % attachment.id,
+            'target': 'self',
+        }
+
+    def _iter_rendered_certificates(self, chunks, data, workers):
+        """
+        Gera, bloco a bloco, as listas de (nome do ficheiro, PDF) à medida que
+        os workers terminam. Em modo de teste, ou com um único worker, os
+        blocos são processados sequencialmente no cursor atual.
+        """
+        report = self.env['report.ao_withholding.report_withholding_certificate']
+        registry = self.env.registry
+        if workers <= 1 or len(chunks) == 1 or registry.in_test_mode():
+            for chunk in chunks:
+                yield report._render_certificates(chunk, data)
+            return
+
+        uid, context = self.env.uid, dict(self.env.context)
+
+        def render_chunk(chunk):
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                return env[report._name]._render_certificates(chunk, data)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_chunk, chunk) for chunk in chunks]
+            for index, future in enumerate(as_completed(futures), start=1):
+                yield future.result()
+                _logger.info("Certificados de retenção: %s/%s blocos gerados.", index, len(chunks))
@@ -0,0 +1,29 @@
+from odoo import models, fields
+
+class WithholdingSummary(models.Model):
+    _name = 'withholding.summary'
+    _description = 'Resumo de Retenções da Fatura'
+    _order = 'move_id, withholding_tax_id'
+
+    move_id = fields.Many2one(
+        'account.move',
+        string="Fatura",
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+    withholding_tax_id = fields.Many2one(
+        'withholding.tax',
+        string="Retenção na Fonte",
+        required=True,
+        index=True,
+        ondelete='restrict'
+    )
+    tax_type = fields.Selection(related='withholding_tax_id.tax_type', store=True)
+    partner_id = fields.Many2one(related='move_id.partner_id', store=True, index=True)
+    date = fields.Date(related='move_id.date', store=True, index=True)
+    company_id = fields.Many2one(related='move_id.company_id', store=True, index=True)
+    currency_id = fields.Many2one(related='move_id.currency_id', store=True)
+    rate = fields.Float(string="% Imposto")
+    base = fields.Monetary(string="Valor Base")
+    amount = fields.Monetary(string="Valor a Reter")
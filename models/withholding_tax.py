@@ -1,4 +1,9 @@
-from odoo import models, fields
+from datetime import timedelta
+
+from odoo import models, fields, api
+
+# Campos das retenções incluídos na configuração em cache da empresa.
+WITHHOLDING_TAX_CONFIG_FIELDS = {'name', 'code', 'tax_type', 'percentage', 'account_id', 'company_id'}
 
 class WithholdingTax(models.Model):
     _name = 'withholding.tax'
@@ -11,7 +16,18 @@ class WithholdingTax(models.Model):
         ('ipu', 'Imposto Predial Urbano'),
         ('iac', 'Imposto sobre Aplicação de Capitais')
     ], string="Tipo de Imposto", required=True, default='ii')
-    percentage = fields.Float(string="% Imposto", required=True)
+    percentage = fields.Float(
+        string="% Imposto",
+        required=True,
+        help="Taxa atualmente em vigor. Ao alterá-la é acrescentada uma nova taxa ao "
+             "histórico, em vigor a partir de hoje; as faturas anteriores não são afetadas."
+    )
+    rate_ids = fields.One2many(
+        'withholding.tax.rate',
+        'tax_id',
+        string="Histórico de Taxas",
+        copy=False
+    )
     account_id = fields.Many2one(
         'account.account',
         string="Conta Contabilística",
@@ -24,4 +40,95 @@ class WithholdingTax(models.Model):
         string="Empresa",
         required=True,
         default=lambda self: self.env.company
-    )
\ No newline at end of file
+    )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        taxes = super().create(vals_list)
+        # A taxa inicial aplica-se a todas as datas.
+        self.env['withholding.tax.rate'].create([
+            {'tax_id': tax.id, 'percentage': tax.percentage}
+            for tax in taxes if not tax.rate_ids
+        ])
+        self.env['res.company'].clear_caches()
+        return taxes
+
+    def write(self, vals):
+        fnames = WITHHOLDING_TAX_CONFIG_FIELDS.intersection(vals)
+        with self.env['res.company']._invalidate_withholding_config(self, fnames):
+            if 'percentage' in vals:
+                vals = dict(vals)
+                percentage = vals.pop('percentage')
+                today = fields.Date.context_today(self)
+                date_from = fields.Date.to_date(self.env.context.get('withholding_rate_date')) or today
+                for tax in self:
+                    if tax._get_rate_percentage(date_from) != percentage:
+                        tax._add_rate(date_from, percentage)
+                    # `percentage` é a taxa em vigor hoje: uma taxa passada ou futura não a altera.
+                    today_percentage = tax._get_rate_percentage(today)
+                    if tax.percentage != today_percentage:
+                        super(WithholdingTax, tax).write({'percentage': today_percentage})
+            return super().write(vals)
+
+    def _get_rate_percentage(self, rate_date):
+        """ Devolve a percentagem do histórico em vigor em `rate_date`, ou a taxa atual fora do histórico. """
+        self.ensure_one()
+        for rate in self.rate_ids:
+            if (not rate.date_from or rate.date_from <= rate_date) and (not rate.date_to or rate_date <= rate.date_to):
+                return rate.percentage
+        return self.percentage
+
+    def _add_rate(self, date_from, percentage):
+        """
+        Acrescenta ao histórico uma taxa em vigor a partir de `date_from`,
+        terminando a vigência da taxa em vigor nessa data.
+        """
+        self.ensure_one()
+        rates = self.rate_ids
+        if not rates:
+            # Retenção sem histórico (criada antes do histórico de taxas): a taxa
+            # atual passa a valer para todas as datas anteriores a `date_from`.
+            rates = self.env['withholding.tax.rate'].create({
+                'tax_id': self.id,
+                'date_to': date_from - timedelta(days=1),
+                'percentage': self.percentage,
+            })
+        same_day = rates.filtered(lambda rate: rate.date_from == date_from)
+        if same_day:
+            same_day.percentage = percentage
+            return same_day
+        current = rates.filtered(lambda rate: (
+            (not rate.date_from or rate.date_from < date_from)
+            and (not rate.date_to or rate.date_to >= date_from)
+        ))
+        if current:
+            date_to = current.date_to
+            current.date_to = date_from - timedelta(days=1)
+        else:
+            next_dates = [rate.date_from for rate in rates if rate.date_from and rate.date_from > date_from]
+            date_to = min(next_dates) - timedelta(days=1) if next_dates else False
+        return self.env['withholding.tax.rate'].create({
+            'tax_id': self.id,
+            'date_from': date_from,
+            'date_to': date_to,
+            'percentage': percentage,
+        })
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['res.company'].clear_caches()
+        return res
+
+    def _refresh_draft_withholding_rates(self):
+        """
+        Volta a resolver a taxa registada nas linhas das faturas em rascunho
+        destas retenções, após uma alteração ao histórico de taxas. As faturas
+        lançadas mantêm a taxa com que foram lançadas.
+        """
+        lines = self.env['account.move.line'].sudo().search([
+            ('withholding_tax_id', 'in', self.ids),
+            ('parent_state', '=', 'draft'),
+        ])
+        if lines:
+            self.env.add_to_compute(lines._fields['withholding_rate'], lines)
+            lines.recompute(['withholding_rate'])
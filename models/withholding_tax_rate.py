@@ -0,0 +1,63 @@
+from odoo import models, fields, api
+from odoo.exceptions import ValidationError
+
+# Campos do histórico incluídos na configuração em cache da empresa.
+WITHHOLDING_RATE_CONFIG_FIELDS = {'tax_id', 'date_from', 'date_to', 'percentage'}
+
+class WithholdingTaxRate(models.Model):
+    _name = 'withholding.tax.rate'
+    _description = 'Histórico de Taxas de Retenção'
+    _order = 'tax_id, date_from desc, id desc'
+
+    tax_id = fields.Many2one(
+        'withholding.tax',
+        string="Retenção na Fonte",
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+    company_id = fields.Many2one(related='tax_id.company_id', store=True)
+    date_from = fields.Date(
+        string="Em Vigor Desde",
+        help="Primeiro dia em que a taxa se aplica. Se vazio, aplica-se a todas as datas anteriores."
+    )
+    date_to = fields.Date(
+        string="Em Vigor Até",
+        help="Último dia em que a taxa se aplica. Se vazio, a taxa continua em vigor."
+    )
+    percentage = fields.Float(string="% Imposto", required=True)
+
+    @api.constrains('tax_id', 'date_from', 'date_to')
+    def _check_validity(self):
+        for rate in self:
+            if rate.date_from and rate.date_to and rate.date_from > rate.date_to:
+                raise ValidationError("A data de início da taxa não pode ser posterior à data de fim.")
+            for other in rate.tax_id.rate_ids - rate:
+                if (not rate.date_to or not other.date_from or other.date_from <= rate.date_to) \
+                        and (not other.date_to or not rate.date_from or rate.date_from <= other.date_to):
+                    raise ValidationError(
+                        "Os períodos de vigência das taxas da retenção %s não se podem sobrepor." % rate.tax_id.name
+                    )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rates = super().create(vals_list)
+        self.env['res.company'].clear_caches()
+        rates.tax_id._refresh_draft_withholding_rates()
+        return rates
+
+    def write(self, vals):
+        taxes = self.tax_id
+        fnames = WITHHOLDING_RATE_CONFIG_FIELDS.intersection(vals)
+        with self.env['res.company']._invalidate_withholding_config(self, fnames):
+            res = super().write(vals)
+        if fnames:
+            (taxes | self.tax_id)._refresh_draft_withholding_rates()
+        return res
+
+    def unlink(self):
+        taxes = self.tax_id
+        res = super().unlink()
+        self.env['res.company'].clear_caches()
+        taxes.exists()._refresh_draft_withholding_rates()
+        return res
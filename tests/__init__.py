@@ -1 +1,2 @@
 from . import test_withholding
+from . import test_withholding_performance
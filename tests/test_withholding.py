@@ -1,5 +1,15 @@
+import io
+import os
+import tempfile
+from unittest.mock import patch
+
+from lxml import etree
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+from odoo import fields
 from odoo.tests.common import tagged, TransactionCase
-from odoo.exceptions import UserError
+from odoo.exceptions import AccessError, UserError, ValidationError
+from odoo.addons.ao_withholding.models.account_move import WITHHOLDING_LOCK_NAMESPACE, WithholdingLockNotAvailable
 
 @tagged('post_install', '-at_install')
 class TestWithholding(TransactionCase):
@@ -187,4 +197,1155 @@ class TestWithholding(TransactionCase):
         self.assertEqual(wt_move_2.line_ids.filtered(lambda l:l.credit > 0).account_id, self.wt_account_10)
 
         # 7. Check residual amount
-        self.assertAlmostEqual(invoice.amount_residual, 1585.0)
\ No newline at end of file
+        self.assertAlmostEqual(invoice.amount_residual, 1585.0)
+
+    def test_03_batch_post_vendor_bills(self):
+        """Test posting several vendor bills at once creates and reconciles all withholding entries."""
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-02-10',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00 * (i + 1),
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        } for i in range(3)])
+
+        invoices._post()
+
+        for i, invoice in enumerate(invoices):
+            self.assertEqual(invoice.state, 'posted')
+            wt_moves = self.env['account.move'].search([
+                ('ref', 'like', f'Retenção na Fatura: {invoice.name} (%')
+            ])
+            self.assertEqual(len(wt_moves), 2)
+            self.assertTrue(all(move.state == 'posted' for move in wt_moves))
+            # withholding = (1000 * (i + 1)) * 6.5% + 500 * 10%
+            withholding = 65.0 * (i + 1) + 50.0
+            self.assertAlmostEqual(invoice.withholding_amount, withholding, places=2)
+            self.assertAlmostEqual(invoice.amount_residual, invoice.amount_total - withholding)
+
+    def test_04_consolidated_withholding_entry(self):
+        """Test a single withholding entry per invoice when the company consolidates withholdings."""
+        self.company.withholding_consolidate = True
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-03-05',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        })
+        invoice._post()
+
+        wt_move = self.env['account.move'].search([
+            ('ref', '=', f'Retenção na Fatura: {invoice.name}')
+        ])
+        self.assertEqual(len(wt_move), 1, "A single consolidated withholding entry was expected.")
+        self.assertEqual(len(wt_move.line_ids), 3)
+
+        debit_line = wt_move.line_ids.filtered(lambda l: l.debit > 0)
+        self.assertAlmostEqual(debit_line.debit, 115.0)
+        self.assertEqual(debit_line.account_id, self.account_payable)
+        credit_lines = wt_move.line_ids.filtered(lambda l: l.credit > 0)
+        self.assertAlmostEqual(sum(credit_lines.filtered(lambda l: l.account_id == self.wt_account_6_5).mapped('credit')), 65.0)
+        self.assertAlmostEqual(sum(credit_lines.filtered(lambda l: l.account_id == self.wt_account_10).mapped('credit')), 50.0)
+
+        self.assertAlmostEqual(invoice.amount_residual, 1385.0)
+
+    def test_05_withholding_summary(self):
+        """Test the stored withholding summary is grouped per tax and follows line changes."""
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-03-10',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 2,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+            ]
+        })
+        summary = invoice.withholding_summary_ids
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary.withholding_tax_id, self.wt_rate_6_5)
+        self.assertAlmostEqual(summary.base, 2000.0)
+        self.assertAlmostEqual(summary.amount, 130.0)
+
+        invoice.invoice_line_ids[1].withholding_tax_id = self.wt_rate_10
+        summary = invoice.withholding_summary_ids
+        self.assertEqual(len(summary), 2)
+        self.assertAlmostEqual(summary.filtered(lambda s: s.withholding_tax_id == self.wt_rate_10).amount, 100.0)
+
+    def test_06_sql_recompute_matches_python(self):
+        """Test the set-based SQL recompute gives the same totals as the per-record compute."""
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-04-01',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 333.33 * (i + 1),
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id if i % 2 else False,
+                }),
+            ]
+        } for i in range(4)])
+        expected = {invoice.id: (invoice.withholding_amount, invoice.net_amount) for invoice in invoices}
+
+        amounts = invoices._get_withholding_amounts_sql()
+        for invoice in invoices:
+            self.assertAlmostEqual(amounts[invoice.id], expected[invoice.id][0], places=2)
+
+        self.env.cr.execute(
+            "UPDATE account_move SET withholding_amount = 0, net_amount = 0 WHERE id IN %s",
+            [tuple(invoices.ids)])
+        invoices.invalidate_cache(['withholding_amount', 'net_amount'])
+        invoices._recompute_withholding_sql(chunk_size=3)
+        for invoice in invoices:
+            self.assertAlmostEqual(invoice.withholding_amount, expected[invoice.id][0], places=2)
+            self.assertAlmostEqual(invoice.net_amount, expected[invoice.id][1], places=2)
+
+        # O recálculo do ORM acima do limiar segue o caminho SQL, com os mesmos totais.
+        AccountMove = type(self.env['account.move'])
+        amounts_sql = AccountMove._get_withholding_amounts_sql
+        total_fields = [invoices._fields['withholding_amount'], invoices._fields['net_amount']]
+        for rounding in ('tax', 'line'):
+            self.company.withholding_rounding = rounding
+            invoices._compute_withholding()
+            expected = {invoice.id: (invoice.withholding_amount, invoice.net_amount) for invoice in invoices}
+
+            self.env.cr.execute(
+                "UPDATE account_move SET withholding_amount = 0, net_amount = 0 WHERE id IN %s",
+                [tuple(invoices.ids)])
+            invoices.invalidate_cache(['withholding_amount', 'net_amount'])
+            with patch('odoo.addons.ao_withholding.models.account_move.WITHHOLDING_SQL_THRESHOLD', 2), \
+                    patch.object(AccountMove, '_get_withholding_amounts_sql', autospec=True,
+                                 side_effect=amounts_sql) as get_amounts_sql:
+                for field in total_fields:
+                    self.env.add_to_compute(field, invoices)
+                invoices.recompute(['withholding_amount', 'net_amount'])
+            get_amounts_sql.assert_called_once()
+            for invoice in invoices:
+                self.assertAlmostEqual(invoice.withholding_amount, expected[invoice.id][0], places=2)
+                self.assertAlmostEqual(invoice.net_amount, expected[invoice.id][1], places=2)
+
+    def test_07_withholding_ledger(self):
+        """Test the withholding ledger is appended on posting and reversed on reset to draft."""
+        self.partner.vat = '5000000000'
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-05-02',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        })
+        invoice._post()
+
+        Ledger = self.env['withholding.ledger']
+        entries = Ledger.search([('move_id', '=', invoice.id)])
+        self.assertEqual(len(entries), 2)
+        entry_6_5 = entries.filtered(lambda e: e.tax_id == self.wt_rate_6_5)
+        self.assertEqual(entry_6_5.partner_vat, '5000000000')
+        self.assertEqual(entry_6_5.tax_type, 'ii')
+        self.assertAlmostEqual(entry_6_5.base, 1000.0)
+        self.assertAlmostEqual(entry_6_5.amount, 65.0)
+        self.assertEqual(entry_6_5.withholding_move_id.withholding_origin_id, invoice)
+
+        withholding_moves = entries.withholding_move_id
+        invoice.button_draft()
+        entries = Ledger.search([('move_id', '=', invoice.id)])
+        self.assertEqual(len(entries), 4)
+        self.assertAlmostEqual(sum(entries.mapped('amount')), 0.0)
+        self.assertEqual(set(withholding_moves.mapped('state')), {'cancel'})
+
+        # A second reset does not reverse the already balanced entries again.
+        invoice.button_cancel()
+        self.assertEqual(Ledger.search_count([('move_id', '=', invoice.id)]), 4)
+
+    def test_08_withholding_report_values(self):
+        """Test the withholding map rows are built per invoice and tax with subtotals per tax type."""
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-06-03',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        })
+        invoice._post()
+
+        values = self.env['report.ao_withholding.report_withholding']._get_report_values([], data={
+            'date_from': '2025-06-01',
+            'date_to': '2025-06-30',
+            'company_id': self.company.id,
+        })
+        groups = {group['tax_type']: group for group in values['groups']}
+        self.assertEqual(set(groups), {'ii', 'iac'})
+        line_6_5 = [line for line in groups['ii']['lines'] if line['move_id'] == invoice.id]
+        self.assertEqual(len(line_6_5), 1)
+        self.assertEqual(line_6_5[0]['rate'], 6.5)
+        self.assertEqual(line_6_5[0]['partner_name'], self.partner.name)
+        self.assertAlmostEqual(line_6_5[0]['amount'], 65.0)
+        self.assertAlmostEqual(values['total_withholding'], sum(g['amount'] for g in values['groups']))
+
+    def test_09_withholding_export_csv(self):
+        """Test the streamed CSV export of the withholding map."""
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-07-07',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        })
+        invoice._post()
+
+        wizard = self.env['withholding.report.wizard'].create({
+            'date_from': '2025-07-01',
+            'date_to': '2025-07-31',
+            'company_id': self.company.id,
+            'export_format': 'csv',
+        })
+        fp, filename, mimetype = wizard._export_to_file()
+        content = fp.read().decode('utf-8-sig').splitlines()
+        fp.close()
+        self.assertEqual(mimetype, 'text/csv')
+        self.assertTrue(filename.endswith('.csv'))
+        self.assertTrue(content[0].startswith('Data;'))
+        self.assertTrue(any(invoice.name in line and 'T6.5' in line for line in content[1:]))
+
+        # Leitura por blocos no cursor da transação, libertado no fim ou quando interrompida
+        report = self.env['report.ao_withholding.report_withholding']
+        query, params = report._get_report_lines_query(self.company.id, wizard.date_from, wizard.date_to)
+        rows = list(report._iter_query_rows(query + " ORDER BY summary.id", params, chunk_size=1))
+        self.assertIn(invoice.id, [row['move_id'] for row in rows])
+        interrupted = report._iter_query_rows(query, params, chunk_size=1)
+        next(interrupted)
+        interrupted.close()
+        self.env.cr.execute("SELECT COUNT(*) FROM pg_cursors WHERE name LIKE 'withholding_%'")
+        self.assertEqual(self.env.cr.fetchone()[0], 0)
+
+    def test_10_agt_declaration_schema(self):
+        """Test the AGT declaration file is valid against its schema and grouped by tax type and NIF."""
+        self.company.vat = '5417000000'
+        self.partner.vat = '5000000000'
+        other_partner = self.env['res.partner'].create({'name': 'Supplier Without NIF'})
+        for partner, tax in ((self.partner, self.wt_rate_6_5), (self.partner, self.wt_rate_10), (other_partner, self.wt_rate_6_5)):
+            invoice = self.env['account.move'].create({
+                'partner_id': partner.id,
+                'move_type': 'in_invoice',
+                'journal_id': self.journal.id,
+                'invoice_date': '2025-08-12',
+                'invoice_line_ids': [(0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': tax.id,
+                })]
+            })
+            invoice._post()
+
+        with tempfile.TemporaryFile() as fp:
+            self.env['withholding.agt.declaration']._write_declaration(
+                fp, self.company, fields.Date.to_date('2025-08-01'), fields.Date.to_date('2025-08-31'))
+            fp.seek(0)
+            declaration = etree.parse(fp)
+
+        xsd_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'agt_withholding_declaration.xsd')
+        with open(xsd_path, 'rb') as xsd_file:
+            schema = etree.XMLSchema(etree.parse(xsd_file))
+        self.assertTrue(schema.validate(declaration), schema.error_log)
+
+        root = declaration.getroot()
+        self.assertEqual(root.findtext('Cabecalho/NIFContribuinte'), '5417000000')
+        ii = root.find("Imposto[@Tipo='ii']")
+        self.assertEqual(ii.xpath('Beneficiario/NIF/text()'), ['5000000000', '999999999'])
+        self.assertEqual(ii.findtext('TotalRetido'), '130.00')
+        self.assertEqual(root.find("Imposto[@Tipo='iac']").findtext('TotalRetido'), '100.00')
+        self.assertEqual(root.findtext('Totais/NumeroDocumentos'), '3')
+
+    def test_11_partner_certificates(self):
+        """Test a certificate is produced per partner with withholdings in the period."""
+        other_partner = self.env['res.partner'].create({'name': 'Other Supplier'})
+        for partner in (self.partner, other_partner):
+            invoice = self.env['account.move'].create({
+                'partner_id': partner.id,
+                'move_type': 'in_invoice',
+                'journal_id': self.journal.id,
+                'invoice_date': '2025-09-15',
+                'invoice_line_ids': [(0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                })]
+            })
+            invoice._post()
+
+        wizard = self.env['withholding.report.wizard'].create({
+            'date_from': '2025-09-01',
+            'date_to': '2025-09-30',
+            'company_id': self.company.id,
+        })
+        partner_ids = wizard._get_certificate_partner_ids()
+        self.assertEqual(set(partner_ids), {self.partner.id, other_partner.id})
+
+        rows_by_partner = self.env['report.ao_withholding.report_withholding_certificate']._get_certificate_rows(
+            self.company.id, wizard.date_from, wizard.date_to, partner_ids)
+        self.assertEqual(len(rows_by_partner[self.partner.id]), 1)
+        self.assertAlmostEqual(rows_by_partner[other_partner.id][0]['amount'], 65.0)
+
+        action = wizard.action_print_certificates()
+        attachment = self.env['ir.attachment'].search([('res_model', '=', wizard._name), ('res_id', '=', wizard.id)])
+        self.assertEqual(action['url'], '/web/content/%s?download=true' % attachment.id)
+        self.assertEqual(attachment.mimetype, 'application/zip')
+
+    def test_12_multi_create_and_write(self):
+        """Test withholding taxes are kept when creating and writing several bills at once."""
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-10-01',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'display_type': 'line_section',
+                    'name': 'Serviços',
+                }),
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': False,
+                }),
+            ]
+        } for __ in range(3)])
+        for invoice in invoices:
+            lines = invoice.invoice_line_ids.filtered(lambda l: not l.display_type)
+            self.assertEqual(lines.mapped('withholding_tax_id'), self.wt_rate_6_5)
+            self.assertAlmostEqual(invoice.withholding_amount, 65.0, places=2)
+
+        invoices.write({'invoice_line_ids': [(0, 0, {
+            'product_id': self.product_consulting.id,
+            'quantity': 1,
+            'price_unit': 500.00,
+            'withholding_tax_id': self.wt_rate_10.id,
+        })]})
+        for invoice in invoices:
+            self.assertEqual(len(invoice.invoice_line_ids), 4)
+            self.assertAlmostEqual(invoice.withholding_amount, 115.0, places=2)
+
+    def test_13_perf_instrumentation(self):
+        """Test posting is measured when the instrumentation sample rate is enabled."""
+        self.env['ir.config_parameter'].sudo().set_param('ao_withholding.perf_sample_rate', '1')
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-10-20',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        })
+        invoice._post()
+
+        stats = self.env['withholding.perf.stat'].search([])
+        self.assertIn('post', stats.mapped('operation'))
+        self.assertIn('create_withholding_entries', stats.mapped('operation'))
+        # O `_post` do lançamento de retenção, encaixado no da fatura, não é medido à parte
+        post_stat = stats.filtered(lambda s: s.operation == 'post')
+        self.assertEqual(len(post_stat), 1)
+        self.assertEqual(post_stat.record_count, 1)
+        self.assertGreater(post_stat.query_count, 0)
+
+        # Retenção: as medições antigas e as que excedem o limite são apagadas
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('ao_withholding.perf_sample_rate', '0')
+        old_stat = stats[-1]
+        self.env.cr.execute(
+            "UPDATE withholding_perf_stat SET create_date = create_date - interval '60 days' WHERE id = %s",
+            [old_stat.id])
+        self.env['withholding.perf.stat']._cron_vacuum()
+        self.assertFalse(self.env['withholding.perf.stat'].search([('id', '=', old_stat.id)]))
+        self.assertTrue(self.env['withholding.perf.stat'].search([('id', 'in', stats.ids)]))
+
+        params.set_param('ao_withholding.perf_max_rows', '1')
+        self.env['withholding.perf.stat']._cron_vacuum()
+        self.assertEqual(self.env['withholding.perf.stat'].search([]), stats[0])
+
+    def test_14_company_withholding_config(self):
+        """Test the cached company configuration follows changes to the company and the rates."""
+        config = self.company._get_withholding_config()
+        self.assertEqual(config.taxes[self.wt_rate_6_5.id].account_id, self.wt_account_6_5.id)
+        self.assertEqual(config.taxes[self.wt_rate_10.id].percentage, 10)
+        with self.assertRaises(TypeError):
+            config.taxes[0] = None
+
+        self.wt_rate_10.account_id = self.wt_account_6_5
+        self.assertEqual(self.company._get_withholding_config().taxes[self.wt_rate_10.id].account_id, self.wt_account_6_5.id)
+
+        journal = self.env['account.journal'].create({
+            'name': 'Retenções',
+            'code': 'RET',
+            'type': 'general',
+            'company_id': self.company.id,
+        })
+        self.company.write({'withholding_journal_id': journal.id, 'withholding_default_ii_id': self.wt_rate_6_5.id})
+        config = self.company._get_withholding_config()
+        self.assertEqual(config.journal_id, journal.id)
+        self.assertEqual(config.default_tax_ids['ii'], self.wt_rate_6_5.id)
+
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-10-25',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        })
+        invoice._post()
+        wt_move = self.env['account.move'].search([('withholding_origin_id', '=', invoice.id)])
+        self.assertEqual(wt_move.journal_id, journal)
+
+    def test_15_withholding_rounding_per_line(self):
+        """Test the per-line rounding policy rounds each line before summing."""
+        self.company.withholding_rounding = 'line'
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-10-26',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 10.07,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            }) for __ in range(3)]
+        })
+        # 10.07 * 6.5% = 0.65455 -> 0.65 per line, 1.95 in total (1.96 when rounding the sum).
+        self.assertAlmostEqual(invoice.withholding_amount, 1.95, places=2)
+        self.assertAlmostEqual(invoice._get_withholding_amounts_sql()[invoice.id], 1.95, places=2)
+
+    def test_16_withholding_dirty_tracking(self):
+        """Test only invoices changed since the last recompute are selected for recompute before certification."""
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-11-03',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        } for __ in range(2)])
+        self.assertEqual(invoices._get_withholding_dirty_moves(), invoices)
+
+        invoices.write({'withholding_dirty': False})
+        self.assertFalse(invoices._get_withholding_dirty_moves())
+
+        invoices[0].write({'invoice_line_ids': [(1, invoices[0].invoice_line_ids.id, {'withholding_tax_id': self.wt_rate_10.id})]})
+        self.assertEqual(invoices._get_withholding_dirty_moves(), invoices[0])
+
+        # `certify` recalcula só a fatura alterada, sem chegar à certificação das faturas limpas
+        AccountMove = type(self.env['account.move'])
+        certification_class = next(
+            cls for cls in AccountMove.__mro__
+            if 'certify' in vars(cls) and cls.__module__.startswith('odoo.addons.opc_certification_ao.')
+        )
+        compute_withholding = AccountMove._compute_withholding
+        computed = []
+
+        def recording_compute_withholding(records):
+            computed.append(records)
+            return compute_withholding(records)
+
+        with patch.object(certification_class, 'certify', autospec=True, return_value=True) as certify, \
+                patch.object(AccountMove, '_compute_withholding', recording_compute_withholding):
+            invoices.certify()
+        certify.assert_called_once()
+        self.assertTrue(computed)
+        self.assertEqual(self.env['account.move'].union(*computed), invoices[0])
+        self.assertFalse(invoices._get_withholding_dirty_moves())
+        self.assertFalse(invoices[0].withholding_dirty)
+        self.assertAlmostEqual(invoices[0].withholding_amount, 100.0, places=2)
+        self.assertAlmostEqual(invoices[1].withholding_amount, 65.0, places=2)
+
+    def test_17_concurrency_safe_posting(self):
+        """Test withholding locks are taken in a deterministic order and lock conflicts are retried."""
+        other_partner = self.env['res.partner'].create({'name': 'A Supplier'})
+        invoices = self.env['account.move'].create([{
+            'partner_id': partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-11-10',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        } for partner in (self.partner, other_partner, self.partner)])
+        keys = invoices._get_withholding_lock_keys()
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 2)
+        self.assertTrue(all(-2 ** 31 <= key < 2 ** 31 for key in keys + [WITHHOLDING_LOCK_NAMESPACE]))
+        self.assertNotIn(WITHHOLDING_LOCK_NAMESPACE, (self.company.id, self.partner.id, other_partner.id))
+
+        # Os bloqueios livres são obtidos sem espera.
+        self.assertIsNone(invoices._lock_withholding_partners(wait=False))
+
+        AccountMove = type(self.env['account.move'])
+        lock_partners = AccountMove._lock_withholding_partners
+        calls = []
+
+        def busy_lock_partners(records, wait=True):
+            calls.append(wait)
+            if len(calls) == 1:
+                raise WithholdingLockNotAvailable()
+            return lock_partners(records, wait=wait)
+
+        with patch.object(AccountMove, '_lock_withholding_partners', busy_lock_partners), \
+                patch('time.sleep') as sleep:
+            invoices._post()
+
+        self.assertEqual(calls, [False, False])
+        sleep.assert_called_once()
+        for invoice in invoices:
+            self.assertAlmostEqual(invoice.amount_residual, 935.0)
+
+    def test_18_deferred_withholding_entries(self):
+        """Test deferred mode queues the invoices and the worker creates each entry exactly once."""
+        self.company.withholding_deferred = True
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-11-20',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        } for __ in range(3)])
+        invoices._post()
+
+        WithholdingMove = self.env['account.move'].with_context(active_test=False)
+        self.assertEqual(set(invoices.mapped('withholding_state')), {'pending'})
+        self.assertFalse(WithholdingMove.search([('withholding_origin_id', 'in', invoices.ids)]))
+        self.assertEqual(self.env['withholding.queue'].search_count([('move_id', 'in', invoices.ids)]), 3)
+
+        self.env['withholding.queue']._cron_process_queue(chunk_size=2, auto_commit=False)
+        self.assertEqual(set(invoices.mapped('withholding_state')), {'done'})
+        for invoice in invoices:
+            self.assertEqual(WithholdingMove.search_count([('withholding_origin_id', '=', invoice.id)]), 1)
+            self.assertAlmostEqual(invoice.amount_residual, 935.0)
+
+        # Reprocessing the same queue entries never duplicates the withholding entries.
+        queue = self.env['withholding.queue'].search([('move_id', 'in', invoices.ids)])
+        queue.write({'state': 'pending'})
+        self.env['withholding.queue']._cron_process_queue(auto_commit=False)
+        self.assertEqual(WithholdingMove.search_count([('withholding_origin_id', 'in', invoices.ids)]), 3)
+
+    def test_19_bulk_withholding_assignment(self):
+        """Test the assignment wizard applies partner and product category defaults to draft bills."""
+        self.partner.withholding_tax_id = self.wt_rate_6_5
+        category = self.env['product.category'].create({'name': 'Rendimentos de Capitais', 'withholding_tax_type': 'iac'})
+        product_capital = self.env['product.product'].create({
+            'name': 'Test Interest',
+            'type': 'service',
+            'categ_id': category.id,
+            'property_account_expense_id': self.expense_account.id,
+        })
+        self.company.withholding_default_iac_id = self.wt_rate_10
+        bills = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-11-25',
+            'invoice_line_ids': [
+                (0, 0, {'product_id': self.product_service.id, 'quantity': 1, 'price_unit': 1000.00}),
+                (0, 0, {'product_id': product_capital.id, 'quantity': 1, 'price_unit': 500.00}),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 200.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        } for __ in range(2)])
+
+        wizard = self.env['withholding.assign.wizard'].with_context(
+            active_model='account.move', active_ids=bills.ids,
+        ).create({'use_category': True})
+        self.assertEqual(wizard.move_ids, bills)
+        wizard.action_apply()
+
+        for bill in bills:
+            service_line, capital_line, consulting_line = bill.invoice_line_ids.sorted('id')
+            self.assertEqual(service_line.withholding_tax_id, self.wt_rate_6_5)
+            self.assertEqual(capital_line.withholding_tax_id, self.wt_rate_10)
+            self.assertEqual(consulting_line.withholding_tax_id, self.wt_rate_10)
+            self.assertAlmostEqual(bill.withholding_amount, 65.0 + 50.0 + 20.0)
+
+        # Sem categorias, a retenção padrão do parceiro substitui as existentes.
+        self.env['withholding.assign.wizard'].create({
+            'move_ids': [(6, 0, bills[:1].ids)],
+            'overwrite': True,
+        }).action_apply()
+        self.assertEqual(bills[0].invoice_line_ids.withholding_tax_id, self.wt_rate_6_5)
+        self.assertAlmostEqual(bills[0].withholding_amount, 1700.0 * 0.065)
+        self.assertAlmostEqual(bills[1].withholding_amount, 135.0)
+
+    def test_20_withholding_rate_history(self):
+        """Test rate changes are effective-dated and never rewrite the rate stored on existing lines."""
+        old_bill = self._create_bill(self.wt_rate_10, '2025-01-10')
+        self.assertEqual(old_bill.invoice_line_ids.withholding_rate, 10)
+
+        self.wt_rate_10.with_context(withholding_rate_date='2025-07-01').percentage = 15
+        rates = self.wt_rate_10.rate_ids.sorted('percentage')
+        self.assertEqual(rates.mapped('percentage'), [10, 15])
+        self.assertEqual(rates[0].date_to, fields.Date.to_date('2025-06-30'))
+        self.assertFalse(rates[1].date_to)
+
+        tax_config = self.company._get_withholding_config().taxes[self.wt_rate_10.id]
+        self.assertEqual(tax_config.get_rate(fields.Date.to_date('2025-06-30')), 10)
+        self.assertEqual(tax_config.get_rate(fields.Date.to_date('2025-07-01')), 15)
+
+        # A fatura existente mantém a taxa registada; as novas usam a taxa em vigor na sua data.
+        self.assertEqual(old_bill.invoice_line_ids.withholding_rate, 10)
+        self.assertAlmostEqual(old_bill.withholding_amount, 100.0)
+        self.assertAlmostEqual(self._create_bill(self.wt_rate_10, '2025-03-01').withholding_amount, 100.0)
+        new_bill = self._create_bill(self.wt_rate_10, '2025-08-01')
+        self.assertAlmostEqual(new_bill.withholding_amount, 150.0)
+        self.assertEqual(new_bill.withholding_summary_ids.rate, 15)
+        self.assertEqual(new_bill._get_withholding_amounts_sql()[new_bill.id], 150.0)
+
+        with self.assertRaises(ValidationError):
+            self.env['withholding.tax.rate'].create({
+                'tax_id': self.wt_rate_10.id,
+                'date_from': '2025-06-01',
+                'date_to': '2025-07-31',
+                'percentage': 12,
+            })
+
+    def test_21_withholding_backfill(self):
+        """Test the chunked backfill restores totals, summaries and ledger of existing invoices and resumes."""
+        invoices = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-12-01',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        } for __ in range(3)])
+        invoices._post()
+        self.env['account.move'].flush()
+
+        # Simular dados de uma versão anterior do módulo.
+        self.env.cr.execute("UPDATE account_move SET withholding_amount = 0, net_amount = amount_total WHERE id IN %s", [tuple(invoices.ids)])
+        self.env.cr.execute("DELETE FROM withholding_summary WHERE move_id IN %s", [tuple(invoices.ids)])
+        self.env.cr.execute("DELETE FROM withholding_ledger WHERE move_id IN %s", [tuple(invoices.ids)])
+        self.env.cr.execute("UPDATE account_move SET withholding_origin_id = NULL WHERE withholding_origin_id IN %s", [tuple(invoices.ids)])
+        self.env['account.move'].invalidate_cache()
+
+        ICP = self.env['ir.config_parameter'].sudo()
+        ICP.set_param('ao_withholding.backfill_done', False)
+        ICP.set_param('ao_withholding.backfill_last_id', min(invoices.ids) - 1)
+        done = self.env['account.move']._withholding_backfill(chunk_size=2, auto_commit=False)
+        self.assertGreaterEqual(done, 3)
+        self.assertEqual(int(ICP.get_param('ao_withholding.backfill_last_id')),
+                         self.env['account.move'].search([], order='id desc', limit=1).id)
+
+        for invoice in invoices:
+            self.assertAlmostEqual(invoice.withholding_amount, 65.0)
+            self.assertAlmostEqual(invoice.net_amount, 935.0)
+            self.assertEqual(invoice.withholding_summary_ids.rate, 6.5)
+            ledger = self.env['withholding.ledger'].search([('move_id', '=', invoice.id)])
+            self.assertAlmostEqual(sum(ledger.mapped('amount')), 65.0)
+            self.assertEqual(ledger.withholding_move_id.withholding_origin_id, invoice)
+
+        # Uma nova execução, já concluído o preenchimento, não trata mais nenhum lançamento.
+        self.assertEqual(self.env['account.move']._withholding_backfill(auto_commit=False), 0)
+
+    def test_22_batch_payment_receipts(self):
+        """Test payment receipts get the withholding of all reconciled invoices precomputed in one pass."""
+        bills = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-12-05',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        } for __ in range(2)])
+        bills._post()
+
+        payments = self.env['account.payment']
+        for bill in bills:
+            payments |= self.env['account.payment.register'].with_context(
+                active_model='account.move', active_ids=bill.ids,
+            ).create({'payment_date': '2025-12-10'})._create_payments()
+
+        values = self.env['report.account.report_payment_receipt']._get_report_values(payments.ids)
+        self.assertEqual(values['docs'], payments)
+        receipts = values['withholding_receipts']
+        for payment, bill in zip(payments, bills):
+            self.assertEqual(list(receipts[payment.id]), [bill.id])
+            receipt = receipts[payment.id][bill.id]
+            self.assertAlmostEqual(receipt['withholding_amount'], 115.0)
+            self.assertAlmostEqual(receipt['net_amount'], bill.amount_total - 115.0)
+            self.assertEqual(sorted((tax['rate'], tax['amount']) for tax in receipt['taxes']), [(6.5, 65.0), (10.0, 50.0)])
+
+    def test_23_withholding_backfill_edge_cases(self):
+        """Test the backfill handles chunks of draft bills, taxes sharing an account and stops once done."""
+        self.wt_rate_10.account_id = self.wt_account_6_5
+        posted = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-12-01',
+            'invoice_line_ids': [
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_6_5.id,
+                }),
+                (0, 0, {
+                    'product_id': self.product_consulting.id,
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        })
+        posted._post()
+        drafts = self.env['account.move'].create([{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-12-02',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        } for __ in range(2)])
+        self.env['account.move'].flush()
+        self.env.cr.execute("DELETE FROM withholding_ledger WHERE move_id = %s", [posted.id])
+        self.env.cr.execute("UPDATE account_move SET withholding_origin_id = NULL WHERE withholding_origin_id = %s", [posted.id])
+        self.env['account.move'].invalidate_cache()
+
+        cron = self.env.ref('ao_withholding.ir_cron_withholding_backfill')
+        cron.active = True
+        ICP = self.env['ir.config_parameter'].sudo()
+        ICP.set_param('ao_withholding.backfill_done', False)
+
+        # Um bloco só com faturas em rascunho não tem razão a preencher.
+        ICP.set_param('ao_withholding.backfill_last_id', min(drafts.ids) - 1)
+        self.env['account.move'].search([('id', 'in', drafts.ids)])._backfill_withholding_ledger()
+        self.env['account.move']._withholding_backfill(chunk_size=len(drafts), auto_commit=False)
+        self.assertFalse(self.env['withholding.ledger'].search([('move_id', 'in', drafts.ids)]))
+
+        # Concluído, a tarefa agendada não altera o seu registo e as execuções seguintes terminam de imediato.
+        self.assertTrue(cron.active)
+        self.assertTrue(ICP.get_param('ao_withholding.backfill_done'))
+        ICP.set_param('ao_withholding.backfill_last_id', min(drafts.ids) - 1)
+        self.assertEqual(self.env['account.move']._withholding_backfill(auto_commit=False), 0)
+        self.assertEqual(int(ICP.get_param('ao_withholding.backfill_last_id')), min(drafts.ids) - 1)
+
+        # Duas retenções na mesma conta dão uma linha de razão cada.
+        self.env['account.move'].browse(posted.id)._backfill_withholding_ledger()
+        ledger = self.env['withholding.ledger'].search([('move_id', '=', posted.id)])
+        self.assertEqual(len(ledger), 2)
+        self.assertEqual(len(ledger.withholding_move_id), 2)
+        self.assertEqual(sorted(ledger.mapped('amount')), [65.0, 100.0])
+        for entry in ledger:
+            self.assertEqual(entry.withholding_move_id.withholding_origin_id, posted)
+            self.assertAlmostEqual(sum(entry.withholding_move_id.line_ids.mapped('credit')), entry.amount)
+
+    def test_24_withholding_rate_history_edge_cases(self):
+        """Test taxes without history keep their old rate for earlier dates and draft bills follow rate changes."""
+        # Retenção criada antes do histórico de taxas.
+        self.wt_rate_6_5.rate_ids.unlink()
+        self.wt_rate_6_5.with_context(withholding_rate_date='2025-07-01').percentage = 8
+        rates = self.wt_rate_6_5.rate_ids.sorted('percentage')
+        self.assertEqual(rates.mapped('percentage'), [6.5, 8])
+        self.assertFalse(rates[0].date_from)
+        self.assertEqual(rates[0].date_to, fields.Date.to_date('2025-06-30'))
+        self.assertAlmostEqual(self._create_bill(self.wt_rate_6_5, '2025-03-01').withholding_amount, 65.0)
+        self.assertAlmostEqual(self._create_bill(self.wt_rate_6_5, '2025-08-01').withholding_amount, 80.0)
+        self.assertEqual(self.wt_rate_6_5.percentage, 8)
+
+        # Uma taxa retroativa atualiza as faturas em rascunho do período, não as lançadas.
+        draft = self._create_bill(self.wt_rate_6_5, '2025-05-10')
+        posted = self._create_bill(self.wt_rate_6_5, '2025-05-10')
+        posted._post()
+        self.wt_rate_6_5.with_context(withholding_rate_date='2025-05-01').percentage = 7
+        self.assertEqual(draft.invoice_line_ids.withholding_rate, 7)
+        self.assertAlmostEqual(draft.withholding_amount, 70.0)
+        self.assertEqual(posted.invoice_line_ids.withholding_rate, 6.5)
+        self.assertAlmostEqual(posted.withholding_amount, 65.0)
+
+        # A taxa atual só muda quando a nova taxa abrange a data de hoje.
+        self.assertEqual(self.wt_rate_6_5.percentage, 8)
+        future = fields.Date.add(fields.Date.today(), years=1)
+        self.wt_rate_6_5.with_context(withholding_rate_date=future).percentage = 9
+        self.assertEqual(self.wt_rate_6_5.percentage, 8)
+        tax_config = self.company._get_withholding_config().taxes[self.wt_rate_6_5.id]
+        self.assertEqual(tax_config.percentage, 8)
+        self.assertEqual(tax_config.get_rate(future), 9)
+        self.wt_rate_6_5.percentage = 10
+        self.assertEqual(self.wt_rate_6_5.percentage, 10)
+        self.assertEqual(self.wt_rate_6_5._get_rate_percentage(future), 9)
+
+    def _create_bill(self, withholding_tax, invoice_date):
+        """Create a bill of 1000 with a single line withheld at `withholding_tax`."""
+        return self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': invoice_date,
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': withholding_tax.id,
+            })]
+        })
+
+    def _create_foreign_currency_bill(self, invoice_date, rate=0.5):
+        """Create a bill in a currency other than the company's, worth 1/`rate` of the company currency."""
+        currency = self.env.ref('base.EUR') if self.company.currency_id != self.env.ref('base.EUR') else self.env.ref('base.USD')
+        currency.active = True
+        self.env['res.currency.rate'].create({
+            'name': invoice_date,
+            'rate': rate,
+            'currency_id': currency.id,
+            'company_id': self.company.id,
+        })
+        return self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'currency_id': currency.id,
+            'invoice_date': invoice_date,
+            'date': invoice_date,
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        })
+
+    def test_25_agt_declaration_company_currency(self):
+        """Test the ledger and the AGT declaration use company currency amounts for foreign currency bills."""
+        self.company.vat = '5417000000'
+        self.partner.vat = '5000000000'
+        bill = self._create_foreign_currency_bill('2025-09-15')
+        bill._post()
+
+        ledger = self.env['withholding.ledger'].search([('move_id', '=', bill.id)])
+        self.assertAlmostEqual(ledger.amount, 65.0)
+        self.assertAlmostEqual(ledger.amount_company, 130.0)
+        self.assertAlmostEqual(ledger.base_company, 2000.0)
+
+        # O lançamento de retenção regista o mesmo valor na contabilidade, com o valor na moeda da fatura.
+        provision_line = ledger.withholding_move_id.line_ids.filtered(lambda l: l.account_id == self.wt_account_6_5)
+        self.assertAlmostEqual(provision_line.credit, ledger.amount_company)
+        self.assertAlmostEqual(provision_line.amount_currency, -65.0)
+        self.assertEqual(provision_line.currency_id, bill.currency_id)
+        self.assertAlmostEqual(bill.amount_residual, bill.net_amount)
+
+        with tempfile.TemporaryFile() as fp:
+            self.env['withholding.agt.declaration']._write_declaration(
+                fp, self.company, fields.Date.to_date('2025-09-01'), fields.Date.to_date('2025-09-30'))
+            fp.seek(0)
+            root = etree.parse(fp).getroot()
+        self.assertEqual(root.findtext('Totais/TotalBase'), '2000.00')
+        self.assertEqual(root.findtext('Totais/TotalRetido'), '130.00')
+
+        # O estorno anula também os valores na moeda da empresa.
+        bill.button_draft()
+        ledger = self.env['withholding.ledger'].search([('move_id', '=', bill.id)])
+        self.assertAlmostEqual(sum(ledger.mapped('amount_company')), 0.0)
+
+    def test_26_certificates_rendered_per_chunk(self):
+        """Test certificates are rendered once per chunk, in company currency, and split into one PDF per partner."""
+        twin_partner = self.env['res.partner'].create({'name': self.partner.name})
+        bill = self._create_foreign_currency_bill('2025-10-15')
+        bill._post()
+        invoice = bill.copy({'partner_id': twin_partner.id, 'invoice_date': '2025-10-15', 'date': '2025-10-15'})
+        invoice._post()
+        partner_ids = [self.partner.id, twin_partner.id]
+
+        Certificate = self.env['report.ao_withholding.report_withholding_certificate']
+        rows_by_partner = Certificate._get_certificate_rows(
+            self.company.id, fields.Date.to_date('2025-10-01'), fields.Date.to_date('2025-10-31'), partner_ids)
+        self.assertAlmostEqual(rows_by_partner[self.partner.id][0]['amount'], 130.0)
+        html = self.env.ref('ao_withholding.action_report_withholding_certificate')._render_qweb_html(
+            [self.partner.id], data={'date_from': '2025-10-01', 'date_to': '2025-10-31', 'company_id': self.company.id},
+        )[0].decode()
+        self.assertIn('Valor Retido (%s)' % self.company.currency_id.name, html)
+
+        # Um único PDF de 3 páginas com os marcadores dos dois certificados.
+        writer = PdfFileWriter()
+        for __ in range(3):
+            writer.addBlankPage(100, 100)
+        writer.addBookmark('Certificado 1', 0)
+        writer.addBookmark('Certificado 2', 2)
+        stream = io.BytesIO()
+        writer.write(stream)
+
+        IrActionsReport = type(self.env['ir.actions.report'])
+        with patch.object(IrActionsReport, '_render_qweb_pdf', autospec=True, return_value=(stream.getvalue(), 'pdf')) as render:
+            certificates = Certificate._render_certificates(partner_ids, {
+                'date_from': '2025-10-01',
+                'date_to': '2025-10-31',
+                'company_id': self.company.id,
+            })
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(certificates), 2)
+        self.assertEqual(len({filename for filename, __ in certificates}), 2)
+        self.assertEqual([PdfFileReader(io.BytesIO(pdf)).getNumPages() for __, pdf in certificates], [2, 1])
+
+        # Sem marcadores que correspondam aos parceiros, o bloco fica num único ficheiro.
+        self.assertIsNone(Certificate._split_certificate_pdf(b'<html/>', 2))
+
+    def test_27_report_company_currency(self):
+        """Test the withholding map converts foreign currency invoices to company currency."""
+        bill = self._create_foreign_currency_bill('2025-11-05')
+        bill._post()
+        values = self.env['report.ao_withholding.report_withholding']._get_report_values([], data={
+            'company_id': self.company.id,
+            'date_from': '2025-11-01',
+            'date_to': '2025-11-30',
+        })
+        line = [line for group in values['groups'] for line in group['lines'] if line['move_id'] == bill.id][0]
+        self.assertAlmostEqual(line['base'], 2000.0)
+        self.assertAlmostEqual(line['amount'], 130.0)
+        self.assertAlmostEqual(values['total_withholding'], sum(group['amount'] for group in values['groups']))
+
+    def test_28_config_cache_invalidation(self):
+        """Test the company configuration cache is only cleared by changes that affect it."""
+        sale_journal = self.env['account.journal'].search([
+            ('type', '=', 'sale'), ('company_id', '=', self.company.id)
+        ], limit=1)
+        ResCompany = type(self.env['res.company'])
+        with patch.object(ResCompany, 'clear_caches') as clear_caches:
+            sale_journal.sequence += 1
+            self.wt_rate_10.name = self.wt_rate_10.name
+            self.wt_rate_10.account_id = self.wt_account_10
+            self.company.withholding_rounding = self.company.withholding_rounding
+            self.assertEqual(clear_caches.call_count, 0)
+
+            self.wt_rate_10.account_id = self.wt_account_6_5
+            self.assertEqual(clear_caches.call_count, 1)
+            self.company.withholding_rounding = 'line' if self.company.withholding_rounding == 'tax' else 'tax'
+            self.assertEqual(clear_caches.call_count, 2)
+
+    def test_29_new_line_withholding_mapped_by_command(self):
+        """Test create commands are matched to their lines and unmatched commands are logged."""
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-10-20',
+            'invoice_line_ids': [
+                (0, 0, {'display_type': 'line_section', 'name': 'Serviços'}),
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'name': 'Linha A',
+                    'quantity': 1,
+                    'price_unit': 1000.00,
+                }),
+                (0, 0, {
+                    'product_id': self.product_service.id,
+                    'name': 'Linha B',
+                    'quantity': 1,
+                    'price_unit': 500.00,
+                    'withholding_tax_id': self.wt_rate_10.id,
+                }),
+            ]
+        })
+        section, line_a, line_b = invoice.invoice_line_ids.sorted('id')
+        self.assertFalse(section.withholding_tax_id)
+        self.assertFalse(line_a.withholding_tax_id)
+        self.assertEqual(line_b.withholding_tax_id, self.wt_rate_10)
+
+        # Um comando sem linha correspondente não desloca a associação dos restantes
+        new_line_vals = [
+            {'name': 'Linha Z', 'withholding_tax_id': self.wt_rate_10.id},
+            {'display_type': 'line_section', 'name': 'Serviços'},
+            {'name': 'Linha A'},
+            {'name': 'Linha B', 'withholding_tax_id': self.wt_rate_6_5.id},
+        ]
+        with self.assertLogs('odoo.addons.ao_withholding.models.account_move', level='WARNING') as logs:
+            mapping = invoice._map_new_line_withholding(new_line_vals)
+        self.assertEqual(mapping, {line_b.id: self.wt_rate_6_5.id})
+        self.assertEqual(len(logs.records), 2)
+
+    def test_30_repost_does_not_duplicate_withholding(self):
+        """Test resetting and re-posting a bill leaves a single posted withholding entry."""
+        invoice = self.env['account.move'].create({
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-05-12',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product_service.id,
+                'quantity': 1,
+                'price_unit': 1000.00,
+                'withholding_tax_id': self.wt_rate_6_5.id,
+            })]
+        })
+        invoice._post()
+        first_moves = self.env['account.move'].search([('withholding_origin_id', '=', invoice.id)])
+
+        invoice.button_draft()
+        self.assertEqual(set(first_moves.mapped('state')), {'cancel'})
+        self.assertFalse(first_moves.line_ids.filtered('reconciled'))
+        invoice._post()
+
+        posted_moves = self.env['account.move'].search([
+            ('withholding_origin_id', '=', invoice.id), ('state', '=', 'posted'),
+        ])
+        self.assertEqual(len(posted_moves), 1)
+        self.assertNotIn(posted_moves, first_moves)
+        withholding_lines = posted_moves.line_ids.filtered(lambda l: l.account_id == self.wt_account_6_5)
+        self.assertAlmostEqual(sum(withholding_lines.mapped('credit')), 65.0)
+        ledger = self.env['withholding.ledger'].search([('move_id', '=', invoice.id)])
+        self.assertAlmostEqual(sum(ledger.mapped('amount')), 65.0)
+
+    def test_31_withholding_reports_check_company_access(self):
+        """Test the SQL-based map, export, declaration and certificates refuse companies the user cannot access."""
+        other_company = self.env['res.company'].create({'name': 'Other Withholding Company'})
+        env = self.env(context=dict(self.env.context, allowed_company_ids=[self.company.id]))
+        data = {'date_from': '2025-01-01', 'date_to': '2025-12-31', 'company_id': other_company.id}
+        date_from, date_to = fields.Date.to_date(data['date_from']), fields.Date.to_date(data['date_to'])
+
+        with self.assertRaises(AccessError):
+            env['report.ao_withholding.report_withholding']._get_report_values([], data=data)
+        with self.assertRaises(AccessError):
+            env['report.ao_withholding.report_withholding']._get_report_lines_query(other_company.id, date_from, date_to)
+        with self.assertRaises(AccessError):
+            env['withholding.agt.declaration']._get_declaration_lines_query(other_company.id, date_from, date_to)
+        with self.assertRaises(AccessError):
+            env['report.ao_withholding.report_withholding_certificate']._get_report_values([self.partner.id], data=data)
+
+        wizard = env['withholding.report.wizard'].create({
+            'date_from': date_from,
+            'date_to': date_to,
+            'company_id': other_company.id,
+            'export_format': 'csv',
+        })
+        with self.assertRaises(AccessError):
+            wizard._export_to_file()
+        with self.assertRaises(AccessError):
+            wizard.action_print_certificates()
+
+        # A empresa permitida continua acessível.
+        env['report.ao_withholding.report_withholding']._get_report_values([], data=dict(data, company_id=self.company.id))
@@ -0,0 +1,230 @@
+import logging
+import os
+import time
+
+from odoo.tests.common import tagged, TransactionCase
+
+_logger = logging.getLogger(__name__)
+
+# Número de faturas medido em cada escala do teste de tempos. Pode ser
+# reduzido para execuções rápidas, ex: WITHHOLDING_BENCHMARK_SCALES=100,1000
+BENCHMARK_SCALES = [
+    int(scale) for scale in os.environ.get('WITHHOLDING_BENCHMARK_SCALES', '100,1000,10000').split(',')
+]
+LINES_PER_BILL = 3
+
+# Orçamentos de consultas, fixos: nenhum destes caminhos pode depender do
+# número de faturas nem do número de retenções por fatura.
+QUERY_BUDGET_SQL_RECOMPUTE = 6
+QUERY_BUDGET_REPORT_VALUES = 8
+QUERY_BUDGET_REPORT_RENDER = 25
+# Consultas acrescentadas pelo módulo ao `create` das faturas, seja qual for o número de faturas.
+QUERY_BUDGET_CREATE_OVERHEAD = 10
+# Criação dos lançamentos de retenção: parte fixa e consultas por fatura (o
+# lançamento e a reconciliação de cada fatura), que não dependem do número
+# de retenções da fatura.
+QUERY_BUDGET_ENTRIES_FIXED = 60
+QUERY_BUDGET_ENTRIES_PER_BILL = 40
+
+
+@tagged('post_install', '-at_install', '-standard', 'withholding_benchmark')
+class TestWithholdingPerformance(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls, *args, **kwargs):
+        super().setUpClass(*args, **kwargs)
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+
+        cls.company = cls.env.ref('base.main_company')
+        cls.journal = cls.env['account.journal'].search([
+            ('type', '=', 'purchase'), ('company_id', '=', cls.company.id)
+        ], limit=1)
+        cls.expense_account = cls.env['account.account'].create({
+            'name': 'Benchmark Expense',
+            'code': 'EXP_BENCH',
+            'account_type': 'expense',
+            'company_id': cls.company.id,
+        })
+        cls.wt_rates = cls.env['withholding.tax']
+        for index, (tax_type, percentage) in enumerate((('ii', 6.5), ('ipu', 15.0), ('iac', 10.0))):
+            account = cls.env['account.account'].create({
+                'name': 'Benchmark Withholding %s' % percentage,
+                'code': 'WT_BENCH_%s' % index,
+                'account_type': 'liability_payable',
+                'company_id': cls.company.id,
+            })
+            cls.wt_rates |= cls.env['withholding.tax'].create({
+                'name': 'Benchmark %s%%' % percentage,
+                'code': 'BENCH%s' % index,
+                'tax_type': tax_type,
+                'percentage': percentage,
+                'account_id': account.id,
+                'company_id': cls.company.id,
+            })
+        cls.partner = cls.env['res.partner'].create({'name': 'Benchmark Supplier', 'vat': '5000000001'})
+        cls.product = cls.env['product.product'].create({
+            'name': 'Benchmark Service',
+            'type': 'service',
+            'property_account_expense_id': cls.expense_account.id,
+        })
+
+    def _prepare_bill_vals_list(self, count, lines=LINES_PER_BILL, with_withholding=True):
+        return [{
+            'partner_id': self.partner.id,
+            'move_type': 'in_invoice',
+            'journal_id': self.journal.id,
+            'invoice_date': '2025-01-31',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product.id,
+                'quantity': 1,
+                'price_unit': 100.0 * (line + 1),
+                'withholding_tax_id': self.wt_rates[line % len(self.wt_rates)].id if with_withholding else False,
+            }) for line in range(lines)],
+        } for __ in range(count)]
+
+    def _report_data(self):
+        return {
+            'date_from': '2025-01-01',
+            'date_to': '2025-01-31',
+            'company_id': self.company.id,
+        }
+
+    def _assert_constant_query_count(self, budget, measure, small=5, large=10):
+        """
+        Mede `measure(count)` para `small` e `large` faturas e verifica que o
+        número de consultas é o mesmo nas duas escalas e está dentro de `budget`.
+        """
+        queries_small = measure(small)
+        queries_large = measure(large)
+        self.assertEqual(queries_large, queries_small,
+                         "The query count grows with the number of bills (%s -> %s)." % (queries_small, queries_large))
+        self.assertLessEqual(queries_large, budget)
+
+    def _measure_query_growth(self, measure, small=5, large=10):
+        """
+        Mede `measure(count)` para `small` e `large` faturas e devolve o número
+        de consultas para `small` faturas e o acréscimo por fatura.
+        """
+        queries_small = measure(small)
+        queries_large = measure(large)
+        return queries_small, (queries_large - queries_small) / (large - small)
+
+    def test_create_query_count(self):
+        """The withholding adds a fixed number of queries to the creation of bills, whatever their number."""
+        Move = self.env['account.move']
+
+        def measure(count):
+            def create_queries(with_withholding):
+                vals_list = self._prepare_bill_vals_list(count, with_withholding=with_withholding)
+                self.env['base'].flush()
+                start = self.cr.sql_log_count
+                Move.create(vals_list)
+                self.env['base'].flush()
+                return self.cr.sql_log_count - start
+            return create_queries(True) - create_queries(False)
+
+        self._assert_constant_query_count(QUERY_BUDGET_CREATE_OVERHEAD, measure)
+
+    def test_withholding_entries_query_count(self):
+        """Creating the withholding entries costs a fixed number of queries per bill, whatever the number of rates."""
+        Move = self.env['account.move']
+        # Em diferido, o `_post` só coloca as faturas na fila: os lançamentos
+        # de retenção são criados à parte, no passo medido.
+        self.company.write({'withholding_deferred': True, 'withholding_consolidate': True})
+
+        def measure_entries(lines):
+            def measure(count):
+                bills = Move.create(self._prepare_bill_vals_list(count, lines=lines))
+                bills._post()
+                self.env['base'].flush()
+                self.env['base'].invalidate_cache()
+                bills = Move.browse(bills.ids)
+                start = self.cr.sql_log_count
+                bills._create_withholding_entries()
+                self.env['base'].flush()
+                return self.cr.sql_log_count - start
+            return self._measure_query_growth(measure)
+
+        fixed_one_rate, per_bill_one_rate = measure_entries(lines=1)
+        fixed, per_bill = measure_entries(lines=len(self.wt_rates))
+        self.assertLessEqual(fixed, QUERY_BUDGET_ENTRIES_FIXED)
+        self.assertLessEqual(per_bill, QUERY_BUDGET_ENTRIES_PER_BILL)
+        self.assertEqual(per_bill, per_bill_one_rate,
+                         "The query count per bill grows with the number of rates (%s -> %s)." % (per_bill_one_rate, per_bill))
+
+    def test_report_render_query_count(self):
+        """Rendering the withholding map runs a fixed number of queries, whatever the number of bills."""
+        Move = self.env['account.move']
+        self.company.withholding_deferred = True
+        report_action = self.env.ref('ao_withholding.action_report_withholding')
+        wizard = self.env['withholding.report.wizard'].create(self._report_data())
+        report_action._render_qweb_html(wizard.ids, data=self._report_data())
+
+        def measure(count):
+            Move.create(self._prepare_bill_vals_list(count))._post()
+            self.env['base'].flush()
+            self.env['base'].invalidate_cache()
+            start = self.cr.sql_log_count
+            report_action._render_qweb_html(wizard.ids, data=self._report_data())
+            return self.cr.sql_log_count - start
+
+        self._assert_constant_query_count(QUERY_BUDGET_REPORT_RENDER, measure)
+
+    def test_recompute_query_count(self):
+        """The SQL recompute runs a constant number of queries per chunk."""
+        bills = self.env['account.move'].create(self._prepare_bill_vals_list(50))
+        with self.assertQueryCount(QUERY_BUDGET_SQL_RECOMPUTE):
+            bills._recompute_withholding_sql()
+
+    def test_report_values_query_count(self):
+        """The withholding map data is fetched with a constant number of queries."""
+        bills = self.env['account.move'].create(self._prepare_bill_vals_list(50))
+        bills._post()
+        report = self.env['report.ao_withholding.report_withholding']
+        with self.assertQueryCount(QUERY_BUDGET_REPORT_VALUES):
+            values = report._get_report_values([], data=self._report_data())
+        self.assertEqual(sum(len(group['lines']) for group in values['groups']), 50 * len(self.wt_rates))
+
+    def test_scaling_timings(self):
+        """Record wall-clock timings of the withholding hot paths at several scales."""
+        report = self.env['report.ao_withholding.report_withholding']
+        report_action = self.env.ref('ao_withholding.action_report_withholding')
+        wizard = self.env['withholding.report.wizard'].create(self._report_data())
+        for scale in BENCHMARK_SCALES:
+            with self.subTest(scale=scale):
+                timings = {}
+
+                start = time.perf_counter()
+                bills = self.env['account.move'].create(self._prepare_bill_vals_list(scale))
+                bills.flush()
+                timings['create'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                bills._compute_withholding()
+                bills.flush()
+                timings['compute'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                bills._recompute_withholding_sql()
+                timings['recompute_sql'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                bills._post()
+                bills.flush()
+                timings['post'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                report._get_report_values([], data=self._report_data())
+                timings['report_values'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                report_action._render_qweb_html(wizard.ids, data=self._report_data())
+                timings['report_render'] = time.perf_counter() - start
+
+                _logger.info(
+                    "Withholding benchmark: %s bills x %s lines x %s rates: %s", scale, LINES_PER_BILL,
+                    len(self.wt_rates), ", ".join("%s=%.2fs" % item for item in timings.items()))
+
+                # Anular as faturas desta escala para que não contem na seguinte.
+                bills.button_draft()
+                bills.button_cancel()